@@ -0,0 +1,611 @@
+#! /usr/bin/env python
+import os
+import sys
+import copy
+import json
+import pickle
+import socket
+import argparse
+import tempfile
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from skimage.color import rgb2lab
+from skimage import io
+
+from text2pal.model import Attn, EncoderRNN, AttnDecoderRNN
+from text2pal.embedding import Dictionary
+from text2pal.inference import PaletteGenerator
+from pal2color.data_loader import process_data, Dataset as ImageDataset, LoadImagenet
+from text2pal.data_loader import Dataset as PaletteDataset
+from pal2color.model import UNet, Discriminator, CHECKPOINT_BLOCKS
+from pal2color.gan import GanModel, train as gan_train
+from pal2color.optimize import optimize_for_inference
+from text2colors.device import add_device_args, setup_device
+from text2colors.amp import Precision
+from text2colors.cpu import CPU_MODES, CPUGenerator, tune_threads
+from text2colors.distributed import launch, init_distributed, cleanup, wrap_pcn
+from text2colors.timing import timeit
+
+
+class LoopAttn(Attn):
+    # the original per-timestep / per-sample implementation, kept as a reference
+    def forward(self, hidden, encoder_outputs, each_size):
+        seq_len = encoder_outputs.size(0)
+        batch_size = encoder_outputs.size(1)
+        attn_energies = hidden.new_zeros(seq_len, batch_size, 1)
+
+        for i in range(seq_len):
+            attn_energies[i] = self.score(hidden, encoder_outputs[i])
+
+        for i in range(batch_size):
+            attn_energies[each_size[i]:, i] = -float('Inf')
+
+        attn_energies = self.softmax(attn_energies)
+        return attn_energies.permute(1, 2, 0)
+
+
+def bench_attn(args, device):
+    hidden_size = 150
+    print('%6s %8s %12s %12s %8s' % ('batch', 'max_len', 'loop (ms)', 'batched (ms)', 'speedup'))
+    for batch_size in args.batch_sizes:
+        for max_len in args.max_lens:
+            attn = Attn(hidden_size, max_len).to(device)
+            ref = LoopAttn(hidden_size, max_len).to(device)
+            ref.load_state_dict(attn.state_dict())
+
+            hidden = torch.randn(batch_size, hidden_size, device=device)
+            encoder_outputs = torch.randn(max_len, batch_size, hidden_size, device=device)
+            each_size = torch.randint(1, max_len + 1, (batch_size,)).tolist()
+
+            with torch.no_grad():
+                out = attn(hidden, encoder_outputs, each_size)
+                expected = ref(hidden, encoder_outputs, each_size)
+                assert torch.allclose(out, expected, atol=1e-6), 'Attn mismatch'
+
+                t_loop = timeit(lambda: ref(hidden, encoder_outputs, each_size), device, args.repeat)
+                t_batched = timeit(lambda: attn(hidden, encoder_outputs, each_size), device, args.repeat)
+
+            print('%6d %8d %12.3f %12.3f %7.1fx' % (batch_size, max_len, t_loop * 1e3,
+                                                   t_batched * 1e3, t_loop / t_batched))
+
+
+def process_data_skimage(image_data, batch_size, imsize):
+    # the original per-image skimage preprocessing, kept as a reference
+    input = torch.zeros(batch_size, 1, imsize, imsize)
+    labels = torch.zeros(batch_size, 2, imsize, imsize)
+    images_np = image_data.numpy().transpose((0, 2, 3, 1))
+
+    for k in range(batch_size):
+        img_lab = rgb2lab(images_np[k], illuminant='D50')
+        input[k] = torch.from_numpy(img_lab[:, :, 0] / 100).unsqueeze(0)
+        img_a_scale = (img_lab[:, :, 1:2] + 88) / 185
+        img_b_scale = (img_lab[:, :, 2:3] + 127) / 212
+        labels[k] = torch.from_numpy(np.concatenate((img_a_scale, img_b_scale), axis=2).transpose((2, 0, 1)))
+
+    return input, labels
+
+
+def bench_lab(args, device):
+    imsize = 256
+    print('%6s %14s %14s %10s' % ('batch', 'skimage (ms)', 'torch (ms)', 'max diff'))
+    for batch_size in args.batch_sizes:
+        images = torch.rand(batch_size, 3, imsize, imsize, dtype=torch.float64)
+        images_dev = images.float().to(device)
+
+        ref_input, ref_labels = process_data_skimage(images, batch_size, imsize)
+        input, labels = process_data(images_dev, batch_size, imsize)
+        diff = max((input.cpu() - ref_input).abs().max().item(),
+                   (labels.cpu() - ref_labels).abs().max().item())
+        assert diff < 1e-4, 'Lab preprocessing mismatch: %g' % diff
+
+        t_ref = timeit(lambda: process_data_skimage(images, batch_size, imsize), torch.device('cpu'), args.repeat)
+        t_new = timeit(lambda: process_data(images_dev, batch_size, imsize), device, args.repeat)
+        print('%6d %14.3f %14.3f %10.2e' % (batch_size, t_ref * 1e3, t_new * 1e3, diff))
+
+
+def peak_memory(fn, device):
+    # peak bytes allocated by fn on CUDA; None on CPU where torch does not track it
+    if device.type != 'cuda':
+        fn()
+        return None
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device)
+    fn()
+    torch.cuda.synchronize()
+    return torch.cuda.max_memory_allocated(device) - base
+
+
+def format_mb(nbytes):
+    return 'n/a' if nbytes is None else '%.1f' % (nbytes / 2.0**20)
+
+
+def bench_hint(args, device):
+    imsize = 256
+    D = Discriminator(1, imsize).to(device).eval()
+    print('%6s %12s %12s %10s %10s %10s' % ('batch', 'cat (ms)', 'bcast (ms)', 'cat MB', 'bcast MB', 'max diff'))
+    for batch_size in args.batch_sizes:
+        x = torch.rand(batch_size, 2, imsize, imsize, device=device, requires_grad=True)
+        hint = torch.rand(batch_size, 16, 1, 1, device=device)
+
+        def cat_step():
+            D(torch.cat((x, hint.expand(-1, -1, imsize, imsize)), dim=1)).sum().backward()
+
+        def bcast_step():
+            D(x, hint).sum().backward()
+
+        with torch.no_grad():
+            diff = (D(torch.cat((x, hint.expand(-1, -1, imsize, imsize)), dim=1)) - D(x, hint)).abs().max().item()
+        assert diff < 1e-4, 'broadcast hint mismatch: %g' % diff
+
+        t_cat, t_bcast = timeit(cat_step, device, args.repeat), timeit(bcast_step, device, args.repeat)
+        m_cat, m_bcast = peak_memory(cat_step, device), peak_memory(bcast_step, device)
+        print('%6d %12.3f %12.3f %10s %10s %10.2e' % (batch_size, t_cat * 1e3, t_bcast * 1e3,
+                                                    format_mb(m_cat), format_mb(m_bcast), diff))
+
+
+def two_forward_train(gm, images, pals, G, D, G_optimizer, D_optimizer, criterion_bce,
+                      criterion_sL1, always_give_global_hint, add_L, gan_loss=0.1, isTrain=True):
+    # the previous PCN step, which ran the generator once for D and again for G
+    gm.image_process(images, pals, always_give_global_hint, add_L)
+    gm.init(G, D)
+    gm.g_forward()
+    gm.d_forward(True)
+    D_loss = gm.d_backward(D_optimizer, criterion_bce, isTrain, gan_loss)
+    gm.init(G, D)
+    gm.g_forward()
+    gm.d_forward(False)
+    sL1_loss, G_loss = gm.g_backward(G_optimizer, D_optimizer, criterion_bce, criterion_sL1, isTrain, gan_loss)
+    return None, None, sL1_loss + G_loss + D_loss, sL1_loss
+
+
+def make_pcn(imsize, device, seed=0):
+    torch.manual_seed(seed)
+    G = UNet(imsize, 1, 1).to(device)
+    D = Discriminator(1, imsize).to(device)
+    G_optimizer = torch.optim.Adam(G.parameters(), lr=2e-4)
+    D_optimizer = torch.optim.Adam(D.parameters(), lr=2e-4)
+    return G, D, G_optimizer, D_optimizer
+
+
+def synthetic_pcn_batch(batch_size, imsize, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    images = torch.rand(batch_size, 3, imsize, imsize, generator=g)
+    pals = torch.rand(batch_size, 5, 3, generator=g) * torch.tensor([100.0, 160.0, 160.0]) \
+           - torch.tensor([0.0, 80.0, 80.0])
+    return images, pals
+
+
+def bench_gan_step(args, device):
+    imsize = args.imsize
+    criterion_sL1, criterion_bce = torch.nn.SmoothL1Loss(), torch.nn.BCEWithLogitsLoss()
+    print('%6s %16s %16s %8s %12s' % ('batch', 'two fwd (img/s)', 'one fwd (img/s)', 'speedup', 'max loss diff'))
+    for batch_size in args.batch_sizes:
+        batches = [synthetic_pcn_batch(batch_size, imsize, seed) for seed in range(args.steps)]
+        models = {'old': make_pcn(imsize, device), 'new': make_pcn(imsize, device)}
+        steps = {'old': two_forward_train, 'new': gan_train}
+        losses, times = {}, {}
+
+        for name in ('old', 'new'):
+            G, D, G_optimizer, D_optimizer = models[name]
+            gm = GanModel(device)
+            losses[name] = []
+
+            def step(images, pals):
+                return steps[name](gm, images, pals, G, D, G_optimizer, D_optimizer,
+                                   criterion_bce, criterion_sL1, 1, 1)[2]
+
+            # loss curves from identical initial weights and data
+            for images, pals in batches:
+                losses[name].append(float(step(images, pals)))
+            times[name] = timeit(lambda: step(*batches[0]), device, args.repeat, warmup=1)
+
+        diff = max(abs(a - b) / max(abs(a), 1e-8) for a, b in zip(losses['old'], losses['new']))
+        assert diff < 1e-3, 'loss curves diverged: relative diff %g' % diff
+        print('%6d %16.2f %16.2f %7.2fx %12.2e' % (batch_size, batch_size / times['old'],
+                                                   batch_size / times['new'], times['old'] / times['new'], diff))
+
+
+def synthetic_tpn(device, n_words=4000, max_len=8, seed=0):
+    torch.manual_seed(seed)
+    input_dict = Dictionary()
+    input_dict.index_elements(['w%d' % i for i in range(n_words)])
+    input_dict.max_len = max_len
+    encoder = EncoderRNN(input_dict.n_words, 150, 4, 0.2).to(device)
+    decoder = AttnDecoderRNN(150, input_dict, 4, 0.2).to(device)
+    return input_dict, encoder, decoder
+
+
+def synthetic_tokens(batch_size, input_dict, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(1, input_dict.max_len + 1, (batch_size,), generator=g)
+    words_index = torch.randint(2, input_dict.n_words, (batch_size, input_dict.max_len), generator=g)
+    words_index[torch.arange(input_dict.max_len).unsqueeze(0) >= lengths.unsqueeze(1)] = 0
+    return words_index, lengths
+
+
+# largest mean abs error against float32 for PCN ab (0-1) and TPN Lab (0-100) outputs
+AMP_TOLERANCE = {'bf16': {'ab': 2e-2, 'lab': 2.0}, 'fp16': {'ab': 5e-3, 'lab': 0.5}}
+
+
+def bench_amp(args, device):
+    modes = ['none', 'bf16'] + (['fp16'] if device.type == 'cuda' else [])
+    imsize = args.imsize
+    criterion_sL1, criterion_bce = torch.nn.SmoothL1Loss(), torch.nn.BCEWithLogitsLoss()
+    input_dict, encoder, decoder = synthetic_tpn(device)
+    print('%6s %6s %14s %10s %14s %14s' % ('mode', 'batch', 'PCN (img/s)', 'PCN MB', 'ab L1 vs fp32', 'Lab L1 vs fp32'))
+    for batch_size in args.batch_sizes:
+        images, pals = synthetic_pcn_batch(batch_size, imsize)
+        words_index, lengths = synthetic_tokens(batch_size, input_dict)
+        reference = {}
+        for mode in modes:
+            G, D, G_optimizer, D_optimizer = make_pcn(imsize, device)
+            gm = GanModel(device, Precision(mode, device))
+
+            # accuracy of reduced-precision inference against float32, before any training step
+            G.eval()
+            gm.image_process(images, pals, 1, 1)
+            with torch.no_grad(), gm.precision.autocast():
+                ab = G(gm.L_image, gm.global_hint).float()
+            G.train()
+
+            def step():
+                return gan_train(gm, images, pals, G, D, G_optimizer, D_optimizer,
+                                 criterion_bce, criterion_sL1, 1, 1)[2]
+
+            loss = float(step())
+            assert np.isfinite(loss), '%s training step gave a non-finite loss' % mode
+
+            t = timeit(step, device, args.repeat, warmup=1)
+            mem = peak_memory(step, device)
+
+            tpn = PaletteGenerator(encoder, decoder, input_dict, device, mode)
+            lab = tpn.generate_lab(words_index, lengths, 1, seed=0)
+            if mode == 'none':
+                reference = {'ab': ab, 'lab': lab}
+            err_ab = (ab - reference['ab']).abs().mean().item()
+            err_lab = (lab - reference['lab']).abs().mean().item()
+
+            print('%6s %6d %14.2f %10s %14.2e %14.2e' % (mode, batch_size, batch_size / t, format_mb(mem),
+                                                         err_ab, err_lab))
+            if mode != 'none':
+                tolerance = AMP_TOLERANCE[mode]
+                assert err_ab < tolerance['ab'], '%s PCN output drifted from float32: %g' % (mode, err_ab)
+                assert err_lab < tolerance['lab'], '%s TPN palettes drifted from float32: %g' % (mode, err_lab)
+
+
+def saved_activations(fn, model):
+    # bytes autograd keeps alive for backward, excluding the weights; works on any device
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved = {}
+
+    def pack(t):
+        storage = t.untyped_storage()
+        if storage.data_ptr() not in params:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, sum(saved.values())
+
+
+def bench_checkpoint(args, device):
+    imsize = args.imsize
+    configs = [('none', ()), ('block4-7', CHECKPOINT_BLOCKS[:4]), ('all', CHECKPOINT_BLOCKS)]
+    print('%10s %6s %10s %10s %10s %12s' % ('blocks', 'batch', 'step (ms)', 'saved MB', 'peak MB', 'max grad diff'))
+    for batch_size in args.batch_sizes:
+        images, pals = synthetic_pcn_batch(batch_size, imsize)
+        gm = GanModel(device)
+        gm.image_process(images, pals, 1, 1)
+        reference = None
+        for name, blocks in configs:
+            torch.manual_seed(0)
+            G = UNet(imsize, 1, 1, blocks).to(device)
+
+            def forward():
+                return G(gm.L_image, gm.global_hint).float().abs().mean()
+
+            def step():
+                G.zero_grad()
+                forward().backward()
+
+            loss, saved = saved_activations(forward, G)
+            G.zero_grad()
+            loss.backward()
+            grads = torch.cat([p.grad.flatten() for p in G.parameters() if p.grad is not None])
+            if reference is None:
+                reference = grads
+            diff = (grads - reference).abs().max().item()
+
+            t = timeit(step, device, args.repeat, warmup=1)
+            mem = peak_memory(step, device)
+            print('%10s %6d %10.2f %10s %10s %12.2e' % (name, batch_size, t * 1e3, format_mb(saved),
+                                                      format_mb(mem), diff))
+
+
+def random_bn(G):
+    # random BatchNorm statistics, so the folds have something to fold
+    for m in G.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.5, 0.5)
+            m.running_var.uniform_(0.5, 2.0)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.uniform_(-0.5, 0.5)
+    return G
+
+
+def bench_fold(args, device):
+    imsize = args.imsize
+    G = random_bn(make_pcn(imsize, device)[0]).eval()
+    G_opt = optimize_for_inference(G)
+
+    print('%6s %10s %12s %12s %8s %10s' % ('batch', 'size', 'eager (ms)', 'folded (ms)', 'speedup', 'max diff'))
+    sizes = [(imsize, imsize), (imsize // 2, imsize + imsize // 2)]
+    for batch_size in args.batch_sizes:
+        for h, w in sizes:
+            L = torch.rand(batch_size, 1, h, w, device=device)
+            hint = torch.rand(batch_size, 16, 1, 1, device=device)
+            with torch.no_grad():
+                diff = (G(L, hint) - G_opt(L, hint)).abs().max().item()
+                assert diff < 1e-4, 'folded UNet mismatch at %dx%d: %g' % (h, w, diff)
+                t_eager = timeit(lambda: G(L, hint), device, args.repeat)
+                t_opt = timeit(lambda: G_opt(L, hint), device, args.repeat)
+            print('%6d %10s %12.2f %12.2f %7.2fx %10.2e' % (batch_size, '%dx%d' % (h, w), t_eager * 1e3,
+                                                          t_opt * 1e3, t_eager / t_opt, diff))
+
+
+def bench_cpu(args, device):
+    if device.type != 'cpu':
+        print('skipped: CPU inference modes need --device cpu')
+        return
+    max_threads = torch.get_num_threads()
+    print('%6s %8s %8s %14s %10s %10s %10s %10s' % ('size', 'model', 'batch', 'mode', 'ms', 'img/s',
+                                                    'threads', 'max diff'))
+    for size in args.sizes:
+        G = random_bn(make_pcn(size, device)[0]).eval()
+        # the --optimize generator too, whose folded convs compute their border taps from the input size
+        generators = {'unet': G, 'folded': optimize_for_inference(G)}
+        # a second size, so a prepacked graph traced at one size is never reused at another
+        other = (torch.rand(2, 1, size // 2, size + size // 2), torch.rand(2, 16, 1, 1))
+        for batch_size in args.image_batch_sizes:
+            L = torch.rand(batch_size, 1, size, size)
+            hint = torch.rand(batch_size, 16, 1, 1)
+            with torch.no_grad():
+                reference, other_reference = G(L, hint), G(*other)
+                for name, source in generators.items():
+                    for mode in CPU_MODES:
+                        # CPUGenerator converts the model it is given in place
+                        model = CPUGenerator(copy.deepcopy(source), mode)
+                        diff = (model(L, hint) - reference).abs().max().item()
+                        other_diff = (model(*other) - other_reference).abs().max().item()
+                        assert max(diff, other_diff) < 1e-4, '%s/%s output mismatch: %g at %dx%d, %g at %dx%d' % (
+                            name, mode, diff, size, size, other_diff, other[0].size(2), other[0].size(3))
+
+                        torch.set_num_threads(max_threads)
+                        threads, _ = tune_threads(lambda: model(L, hint), repeat=max(args.repeat // 4, 1))
+                        t = timeit(lambda: model(L, hint), device, args.repeat)
+                        print('%6d %8s %8d %14s %10.2f %10.2f %10d %10.2e' % (
+                            size, name, batch_size, mode, t * 1e3, batch_size / t, threads, max(diff, other_diff)))
+    torch.set_num_threads(max_threads)
+
+
+def ddp_steps(args):
+    # one DDP process: trains from the same weights on its own batches, then checks all ranks agree
+    init_distributed(args)
+    try:
+        torch.set_num_threads(1)
+        device = torch.device('cpu')
+        G, D, G_optimizer, D_optimizer = make_pcn(args.imsize, device)
+        G_train, D_train = wrap_pcn(G, D, device)
+        gm = GanModel(device)
+        criterion_sL1, criterion_bce = torch.nn.SmoothL1Loss(), torch.nn.BCEWithLogitsLoss()
+        for step in range(args.steps):
+            images, pals = synthetic_pcn_batch(2, args.imsize, seed=step * args.world_size + args.rank)
+            loss = gan_train(gm, images, pals, G_train, D_train, G_optimizer, D_optimizer,
+                             criterion_bce, criterion_sL1, 1, 1)[2]
+            assert torch.isfinite(loss), 'rank %d: loss is %s at step %d' % (args.rank, loss, step)
+
+        params = torch.cat([p.detach().flatten() for p in list(G.parameters()) + list(D.parameters())])
+        rank0 = params.clone()
+        torch.distributed.broadcast(rank0, 0)
+        diff = (params - rank0).abs().max().item()
+        assert diff == 0, 'rank %d: weights differ from rank 0 by %g' % (args.rank, diff)
+        if args.rank == 0:
+            print('%d processes, %d steps: final loss %.4f, weights identical on every rank'
+                  % (args.world_size, args.steps, float(loss)))
+    finally:
+        cleanup()
+
+
+def bench_ddp(args, device):
+    # a gloo smoke test of PCN training with DistributedDataParallel, on CPU
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    ddp_args = argparse.Namespace(world_size=2, dist_backend='gloo', dist_url='tcp://127.0.0.1:%d' % port,
+                                  num_threads=1, imsize=args.imsize, steps=args.steps)
+    launch(ddp_steps, ddp_args)
+
+
+def write_synthetic_data(root, input_dict, num_samples, imsize, seed=0):
+    # the on-disk formats the loaders read: pickled images and palettes, PNG files and pickled names
+    rng = np.random.RandomState(seed)
+    images = rng.randint(0, 256, (num_samples, 3, imsize, imsize)).astype(np.uint8)
+    palettes = rng.randint(0, 256, (num_samples, 15))
+    names = [['w%d' % i for i in rng.randint(0, input_dict.n_words - 2, rng.randint(1, input_dict.max_len + 1))]
+             for _ in range(num_samples)]
+
+    paths = {name: os.path.join(root, name) for name in ('images.pkl', 'palettes.pkl', 'palettes.npy',
+                                                        'names.pkl', 'palettes_rgb.pkl', 'png')}
+    for name, obj in (('images.pkl', list(images)), ('palettes.pkl', palettes),
+                      ('names.pkl', names), ('palettes_rgb.pkl', palettes.reshape(-1, 5, 3))):
+        with open(paths[name], 'wb') as f:
+            pickle.dump(obj, f)
+    np.save(paths['palettes.npy'], palettes)
+    os.makedirs(paths['png'])
+    for i, image in enumerate(images):
+        io.imsave(os.path.join(paths['png'], '%d.png' % i), image.transpose(1, 2, 0), check_contrast=False)
+    return paths
+
+
+def loader_epoch(dataset, batch_size, num_workers, repeat):
+    # seconds per epoch, including worker start-up and collation
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+
+    def epoch():
+        for _ in loader:
+            pass
+
+    return timeit(epoch, torch.device('cpu'), repeat, warmup=1)
+
+
+def bench_suite(args, device):
+    """Times every stage of both networks on synthetic data; returns {name: result}.
+
+    Each result has ``ms`` per call and ``per_s``, the samples (prompts,
+    images) processed per second. Run with ``--json`` to save the results and
+    ``--baseline`` to compare them against a saved run.
+    """
+    results = {}
+
+    def record(name, t, items):
+        results[name] = {'ms': t * 1e3, 'per_s': items / t}
+        print('%-40s %12.3f %14.2f' % (name, t * 1e3, items / t))
+
+    print('%-40s %12s %14s' % ('stage', 'ms', 'samples/s'))
+    input_dict, encoder, decoder = synthetic_tpn(device)
+    tpn = PaletteGenerator(encoder, decoder, input_dict, device)
+    hidden_size = encoder.hidden_size
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            for max_len in args.max_lens:
+                attn = Attn(hidden_size, max_len).to(device)
+                hidden = torch.randn(batch_size, hidden_size, device=device)
+                encoder_outputs = torch.randn(max_len, batch_size, hidden_size, device=device)
+                each_size = torch.randint(1, max_len + 1, (batch_size,)).tolist()
+                record('attn/batch=%d/max_len=%d' % (batch_size, max_len),
+                       timeit(lambda: attn(hidden, encoder_outputs, each_size), device, args.repeat), batch_size)
+
+            words_index, lengths = synthetic_tokens(batch_size, input_dict)
+            record('tpn_decode/batch=%d' % batch_size,
+                   timeit(lambda: tpn.generate_lab(words_index, lengths, 1, seed=0), device, args.repeat), batch_size)
+
+    for size in args.sizes:
+        G = make_pcn(size, device)[0]
+        D = Discriminator(1, size).to(device)
+        for batch_size in args.image_batch_sizes:
+            images, pals = synthetic_pcn_batch(batch_size, size)
+            images = images.to(device)
+            L = torch.rand(batch_size, 1, size, size, device=device)
+            ab = torch.rand(batch_size, 2, size, size, device=device)
+            hint = torch.rand(batch_size, 16, 1, 1, device=device)
+
+            def unet_step():
+                G.zero_grad()
+                G(L, hint).mean().backward()
+
+            def d_step():
+                D.zero_grad()
+                D(ab, hint).mean().backward()
+
+            with torch.no_grad():
+                G.eval()
+                record('unet_forward/%d/batch=%d' % (size, batch_size),
+                       timeit(lambda: G(L, hint), device, args.repeat), batch_size)
+                G.train()
+                record('process_data/%d/batch=%d' % (size, batch_size),
+                       timeit(lambda: process_data(images, batch_size, size), device, args.repeat), batch_size)
+            record('unet_forward_backward/%d/batch=%d' % (size, batch_size),
+                   timeit(unet_step, device, args.repeat, warmup=1), batch_size)
+            record('discriminator_forward_backward/%d/batch=%d' % (size, batch_size),
+                   timeit(d_step, device, args.repeat, warmup=1), batch_size)
+
+    with tempfile.TemporaryDirectory() as root:
+        paths = write_synthetic_data(root, input_dict, args.loader_samples, args.imsize)
+        datasets = {'LoadImagenet': LoadImagenet(paths['images.pkl'], paths['palettes.pkl']),
+                    'pal2color.Dataset': ImageDataset(paths['png'], paths['palettes.npy'], transforms.ToTensor()),
+                    'text2pal.Dataset': PaletteDataset(paths['names.pkl'], paths['palettes_rgb.pkl'], input_dict)}
+        repeat = max(args.repeat // 10, 1)
+        for name, dataset in datasets.items():
+            for batch_size in args.batch_sizes:
+                record('loader/%s/batch=%d' % (name, batch_size),
+                       loader_epoch(dataset, batch_size, args.loader_workers, repeat), len(dataset))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # prints each shared stage against the baseline; returns the stages slower by more than tolerance
+    regressions = []
+    print('%-40s %12s %12s %8s' % ('stage', 'baseline ms', 'ms', 'speedup'))
+    for name in sorted(set(results) & set(baseline)):
+        old, new = baseline[name]['ms'], results[name]['ms']
+        flag = ''
+        if new > old * (1 + tolerance):
+            regressions.append(name)
+            flag = '  slower'
+        print('%-40s %12.3f %12.3f %7.2fx%s' % (name, old, new, old / new, flag))
+    for name in sorted(set(results) ^ set(baseline)):
+        print('%-40s only in %s' % (name, 'this run' if name in results else 'the baseline'))
+    return regressions
+
+
+BENCHMARKS = {
+    'attn': bench_attn,
+    'lab': bench_lab,
+    'hint': bench_hint,
+    'gan_step': bench_gan_step,
+    'amp': bench_amp,
+    'checkpoint': bench_checkpoint,
+    'fold': bench_fold,
+    'cpu': bench_cpu,
+    'ddp': bench_ddp,
+    'suite': bench_suite,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Text2Colors micro-benchmarks')
+    parser.add_argument('benchmarks', nargs='*', default=sorted(BENCHMARKS),
+                        help='which benchmarks to run: %s' % ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 32, 128])
+    parser.add_argument('--max_lens', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--imsize', type=int, default=64, help='image size for the PCN benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256],
+                        help='image sizes for the cpu and suite benchmarks')
+    parser.add_argument('--image_batch_sizes', type=int, nargs='+', default=[1, 8],
+                        help='batch sizes at each of --sizes')
+    parser.add_argument('--steps', type=int, default=5, help='training steps compared for loss parity')
+    parser.add_argument('--loader_samples', type=int, default=256, help='synthetic samples per loader benchmark')
+    parser.add_argument('--loader_workers', type=int, default=2)
+    parser.add_argument('--json', type=str, default=None, help='write the suite results to this file')
+    parser.add_argument('--baseline', type=str, default=None, help='compare the suite results with this file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='fraction a stage may be slower than the baseline before it is reported')
+    parser.add_argument('--gpu', type=int, default=0)
+    add_device_args(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    device = setup_device(args)
+    results = {}
+    for name in args.benchmarks:
+        print('== %s' % name)
+        results.update(BENCHMARKS[name](args, device) or {})
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'device': str(device), 'torch': torch.__version__, 'threads': torch.get_num_threads(),
+                       'args': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+        print('Saved %s' % args.json)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print('== compare with %s (%s, torch %s)' % (args.baseline, baseline['device'], baseline['torch']))
+        if compare(results, baseline['results'], args.tolerance):
+            sys.exit(1)
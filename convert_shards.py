@@ -0,0 +1,14 @@
+#! /usr/bin/env python
+import argparse
+
+from pal2color.data_loader import convert_shard, list_shards
+
+parser = argparse.ArgumentParser(description='Convert pickled PCN shards to memory-mapped uint8 shards')
+parser.add_argument('--data', type=str, default='bird256', choices=['imagenet','bird256'])
+parser.add_argument('--planes', type=int, default=0, help='also store float16 L/ab planes')
+parser.add_argument('--chunk_size', type=int, default=512)
+args = parser.parse_args()
+
+for image_dir, pal_dir, shard_dir in list_shards(args.data):
+    print("Converting %s -> %s" % (image_dir, shard_dir))
+    convert_shard(image_dir, pal_dir, shard_dir, args.planes, args.chunk_size)
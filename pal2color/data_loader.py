@@ -8,9 +8,14 @@ import torch.utils.data as data
 import torchvision.datasets as dsets
 import torchvision.transforms as transforms
 from pal2color.global_hint import *
+from pal2color import lab
 
 import re
+import glob
 import pickle
+import shutil
+import threading
+from queue import Queue
 
 def atoi(text):
     return int(text) if text.isdigit() else text
@@ -62,18 +67,283 @@ class LoadImagenet(data.Dataset):
         return self.image_data[idx], self.pal_data[idx]
 
 
-def Color_Dataloader(dataset, batch_size, idx=0):
+def convert_shard(image_dir, pal_dir, out_dir, planes=False, chunk_size=512):
+    """Converts a pickled image/palette shard into a ShardDataset directory.
+
+    Images are stored as raw uint8 (N, 3, H, W) in ``images.npy``; with ``planes``
+    the scaled L and ab planes that process_data would produce are also stored
+    as float16 in ``L.npy`` and ``ab.npy``. Palettes are stored in Lab.
+    """
+    # write next to the target and rename at the end, so load_shard never sees a partial shard
+    final_dir, out_dir = out_dir, out_dir + '.tmp'
+    if os.path.isdir(out_dir): shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    with open(pal_dir,'rb') as f:
+        pal_data = rgb2lab(np.asarray(pickle.load(f))
+                           .reshape(-1,5,3) / 256
+                           ,illuminant='D50')
+    np.save(os.path.join(out_dir, 'palettes.npy'), pal_data.astype(np.float32))
+
+    with open(image_dir,'rb') as f:
+        image_data = pickle.load(f)
+    num_images = len(image_data)
+    shape = (num_images,) + np.asarray(image_data[0]).shape
+
+    images = np.lib.format.open_memmap(os.path.join(out_dir, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=shape)
+    if planes:
+        L = np.lib.format.open_memmap(os.path.join(out_dir, 'L.npy'), mode='w+',
+                                      dtype=np.float16, shape=(num_images, 1) + shape[2:])
+        ab = np.lib.format.open_memmap(os.path.join(out_dir, 'ab.npy'), mode='w+',
+                                       dtype=np.float16, shape=(num_images, 2) + shape[2:])
+
+    for start in range(0, num_images, chunk_size):
+        end = min(start + chunk_size, num_images)
+        chunk = np.asarray(image_data[start:end], dtype=np.uint8)
+        images[start:end] = chunk
+        if planes:
+            inputs, labels = process_data(torch.from_numpy(chunk), end - start, shape[-1])
+            L[start:end] = inputs.numpy().astype(np.float16)
+            ab[start:end] = labels.numpy().astype(np.float16)
+
+    images.flush()
+    if planes:
+        L.flush()
+        ab.flush()
+    del images
+    if planes:
+        del L, ab
+
+    if os.path.isdir(final_dir): shutil.rmtree(final_dir)
+    os.rename(out_dir, final_dir)
+
+
+class ShardDataset(data.Dataset):
+    """Reads a shard written by convert_shard through memory maps.
+
+    Nothing is loaded up front, so resident memory does not grow with the shard
+    and DataLoader workers share the page cache. Samples are uint8 images, or
+    the precomputed (L, ab) planes when ``use_planes`` is set.
+    """
+    def __init__(self, shard_dir, use_planes=False):
+        self.shard_dir = shard_dir
+        self.use_planes = use_planes
+        self.arrays = None
+        self.data_size = self._open()['palettes'].shape[0]
+
+    def _open(self):
+        if self.arrays is None:
+            names = ['palettes', 'L', 'ab'] if self.use_planes else ['palettes', 'images']
+            self.arrays = {name: np.load(os.path.join(self.shard_dir, name + '.npy'), mmap_mode='r')
+                           for name in names}
+        return self.arrays
+
+    def __getstate__(self):
+        # re-open the memory maps in each worker instead of pickling their contents
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def __len__(self):
+        return self.data_size
+
+    def __getitem__(self, idx):
+        arrays = self._open()
+        pal = torch.from_numpy(np.array(arrays['palettes'][idx]))
+        if self.use_planes:
+            return (torch.from_numpy(np.array(arrays['L'][idx])),
+                    torch.from_numpy(np.array(arrays['ab'][idx]))), pal
+        return torch.from_numpy(np.array(arrays['images'][idx])), pal
+
+
+def load_shard(image_dir, pal_dir, shard_dir, use_planes=False):
+    if os.path.isdir(shard_dir):
+        return ShardDataset(shard_dir, use_planes)
+    return LoadImagenet(image_dir, pal_dir)
+
+
+def shard_size(image_dir, pal_dir, shard_dir):
+    if os.path.isdir(shard_dir):
+        return np.load(os.path.join(shard_dir, 'palettes.npy'), mmap_mode='r').shape[0]
+    with open(pal_dir,'rb') as f:
+        return len(pickle.load(f))
+
+
+class ShardStream(data.IterableDataset):
+    """Streams every shard once per epoch, in a shuffled order.
+
+    The next shard is loaded on a background thread while the current one is
+    consumed. At most ``1 + prefetch_shards`` shards are resident per DataLoader
+    worker, and each worker reads a disjoint subset of the shards. With
+    ``world_size`` > 1 the shards are also split across ranks, and every worker
+    stops at the size of the smallest split so all ranks run the same number
+    of steps; this needs at least ``world_size * num_workers`` shards, where
+    ``num_workers`` is the DataLoader's.
+    """
+    def __init__(self, shards, use_planes=False, shuffle=True, prefetch_shards=1, seed=0,
+                 rank=0, world_size=1, num_workers=1):
+        self.shards = shards
+        self.use_planes = use_planes
+        self.shuffle = shuffle
+        self.prefetch_shards = prefetch_shards
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.num_workers = num_workers
+        self.epoch = 0
+        self.sizes = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard_sizes(self):
+        if self.sizes is None:
+            self.sizes = [shard_size(*shard) for shard in self.shards]
+        return self.sizes
+
+    def __len__(self):
+        # what this rank's workers yield together in the current epoch
+        if self.world_size == 1:
+            return sum(self.shard_sizes())
+        _, limit = self._slots(self._generator(), self.num_workers)
+        return limit * self.num_workers
+
+    def _generator(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        return g
+
+    def _slots(self, g, num_workers):
+        # every rank draws the same order, then takes its own slots of it
+        order = torch.randperm(len(self.shards), generator=g).tolist() if self.shuffle \
+                else list(range(len(self.shards)))
+        num_slots = self.world_size * num_workers
+        slots = [order[slot::num_slots] for slot in range(num_slots)]
+
+        limit = None
+        if self.world_size > 1:
+            # an empty slot would cap every rank at zero samples
+            if len(self.shards) < num_slots:
+                raise ValueError('%d shards cannot be split across %d ranks x %d loader workers; '
+                                 'use more shards or fewer workers' % (len(self.shards), self.world_size,
+                                                                       num_workers))
+            sizes = self.shard_sizes()
+            limit = min(sum(sizes[i] for i in slot) for slot in slots)
+        return slots, limit
+
+    def _worker_shards(self, g):
+        worker_info = data.get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info is not None else (1, 0)
+        slots, limit = self._slots(g, num_workers)
+        return [self.shards[i] for i in slots[self.rank * num_workers + worker_id]], limit
+
+    def __iter__(self):
+        g = self._generator()
+        shards, limit = self._worker_shards(g)
+        slots = threading.Semaphore(self.prefetch_shards + 1)
+        stop = threading.Event()
+        loaded = Queue()
+
+        def load():
+            try:
+                for shard in shards:
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    loaded.put(load_shard(*shard, use_planes=self.use_planes))
+            except Exception as e:
+                loaded.put(e)
+            loaded.put(None)
+
+        threading.Thread(target=load, daemon=True).start()
+
+        count = 0
+        try:
+            while limit is None or count < limit:
+                shard = loaded.get()
+                if shard is None:
+                    break
+                if isinstance(shard, Exception):
+                    raise shard
+
+                order = torch.randperm(len(shard), generator=g) if self.shuffle \
+                        else torch.arange(len(shard))
+                for idx in order.tolist():
+                    if limit is not None and count == limit:
+                        break
+                    count += 1
+                    yield shard[idx]
+
+                del shard
+                slots.release()
+        finally:
+            # unblock the loader if we stopped early
+            stop.set()
+            slots.release()
+
+
+def list_shards(dataset):
+    if dataset == 'imagenet':
+        src_dir = './data/imagenet/train_palette_set_origin'
+        shard_root = './data/imagenet/shards'
+        image_dirs = glob.glob(os.path.join(src_dir, 'train_images_*.txt'))
+        idxs = sorted([os.path.basename(d)[len('train_images_'):-len('.txt')] for d in image_dirs],
+                      key=natural_keys)
+        return [(os.path.join(src_dir, 'train_images_%s.txt' % idx),
+                 os.path.join(src_dir, 'train_palette_%s.txt' % idx),
+                 os.path.join(shard_root, 'train_%s' % idx)) for idx in idxs]
+
+    return [('./data/bird256/train_palette/train_images_origin.txt',
+             './data/bird256/train_palette/train_palette_origin.txt',
+             './data/bird256/shards/train_origin')]
+
+
+def lab_collate(batch):
+    # runs the Lab conversion inside the DataLoader workers
+    images, pals = data.dataloader.default_collate(batch)
+    if isinstance(images, (tuple, list)):
+        return images, pals
+    inputs, labels = process_data(images, images.size(0), images.size(3))
+    return (inputs, labels), pals
+
+
+def distributed_sampler(dataset, rank=0, world_size=1):
+    # each rank sees its own 1/world_size of every epoch; call set_epoch to reshuffle
+    if world_size == 1:
+        return None
+    return data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
+
+
+def Color_Dataloader(dataset, batch_size, idx=0, preprocess_in_workers=False, use_planes=False,
+                     all_shards=False, prefetch_shards=1, rank=0, world_size=1):
+
+    collate_fn = lab_collate if preprocess_in_workers else None
+
+    if all_shards:
+        num_workers = 2
+        train_dataset = ShardStream(list_shards(dataset), use_planes, prefetch_shards=prefetch_shards,
+                                    rank=rank, world_size=world_size, num_workers=num_workers)
+        train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
+                                                   batch_size=batch_size,
+                                                   num_workers=num_workers,
+                                                   collate_fn=collate_fn)
+        imsize = 256
+        return (train_dataset, train_loader, imsize)
 
     if dataset == 'imagenet':
 
         traindir = './data/imagenet/train_palette_set_origin/train_images_%d.txt' % (idx)
         pal_traindir = './data/imagenet/train_palette_set_origin/train_palette_%d.txt' % (idx)
+        shard_dir = './data/imagenet/shards/train_%d' % (idx)
         
-        train_dataset = LoadImagenet(traindir, pal_traindir)
+        train_dataset = load_shard(traindir, pal_traindir, shard_dir, use_planes)
         train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                    batch_size=batch_size,
-                                                   shuffle=True,
-                                                   num_workers=2)
+                                                   shuffle=world_size == 1,
+                                                   sampler=distributed_sampler(train_dataset, rank, world_size),
+                                                   num_workers=2,
+                                                   collate_fn=collate_fn)
 
         imsize = 256
 
@@ -81,12 +351,15 @@ def Color_Dataloader(dataset, batch_size, idx=0):
 
         traindir = './data/bird256/train_palette/train_images_origin.txt'
         pal_traindir = './data/bird256/train_palette/train_palette_origin.txt'
+        shard_dir = './data/bird256/shards/train_origin'
         
-        train_dataset = LoadImagenet(traindir, pal_traindir)
+        train_dataset = load_shard(traindir, pal_traindir, shard_dir, use_planes)
         train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                    batch_size=batch_size,
-                                                   shuffle=True,
-                                                   num_workers=2)
+                                                   shuffle=world_size == 1,
+                                                   sampler=distributed_sampler(train_dataset, rank, world_size),
+                                                   num_workers=2,
+                                                   collate_fn=collate_fn)
 
         imsize = 256
 
@@ -96,40 +369,38 @@ def Color_Dataloader(dataset, batch_size, idx=0):
 
 def process_palette_ab(pal_data, batch_size):
 
+    pal_data = torch.as_tensor(pal_data)
     img_a_scale = (pal_data[:, :, 1:2] + 88) / 185
     img_b_scale = (pal_data[:, :, 2:3] + 127) / 212
-    img_ab_scale = np.concatenate((img_a_scale,img_b_scale),axis=2)
-    ab_for_global = torch.from_numpy(img_ab_scale).float()
+    img_ab_scale = torch.cat((img_a_scale, img_b_scale), dim=2)
+    ab_for_global = img_ab_scale.float()
     ab_for_global = ab_for_global.view(batch_size, 10).unsqueeze(2).unsqueeze(2)
 
     return ab_for_global
 
 def process_palette_lab(pal_data, batch_size):
 
+    pal_data = torch.as_tensor(pal_data)
     img_l = pal_data[:, :, 0:1] / 100
     img_a_scale = (pal_data[:, :, 1:2] + 88) / 185
     img_b_scale = (pal_data[:, :, 2:3] + 127) / 212
-    img_lab_scale = np.concatenate((img_l, img_a_scale, img_b_scale),axis=2)
-    lab_for_global = torch.from_numpy(img_lab_scale).float()
+    img_lab_scale = torch.cat((img_l, img_a_scale, img_b_scale), dim=2)
+    lab_for_global = img_lab_scale.float()
     lab_for_global = lab_for_global.view(batch_size, 15).unsqueeze(2).unsqueeze(2)
 
     return lab_for_global
 
 def process_data(image_data, batch_size, imsize):
-    input = torch.zeros(batch_size, 1, imsize, imsize)
-    labels = torch.zeros(batch_size, 2, imsize, imsize)
-    images_np = image_data.numpy().transpose((0, 2, 3, 1))
-
-    for k in range(batch_size):
-
-        img_lab = rgb2lab(images_np[k], illuminant='D50')
-        img_l = img_lab[:, :,0] / 100
-        input[k] = torch.from_numpy(np.expand_dims(img_l, 0))
+    # batched RGB -> Lab on whatever device image_data lives on
+    image_data = torch.as_tensor(image_data)
+    if not image_data.is_floating_point():
+        image_data = image_data.float() / 255
+    img_lab = lab.rgb2lab(image_data, dim=1)
 
-        img_a_scale = (img_lab[:, :, 1:2] + 88) / 185
-        img_b_scale = (img_lab[:, :, 2:3] + 127) / 212
+    input = (img_lab[:, 0:1] / 100).float()
 
-        img_ab_scale = np.concatenate((img_a_scale,img_b_scale),axis=2)
-        labels[k] = torch.from_numpy(img_ab_scale.transpose((2, 0, 1)))
+    img_a_scale = (img_lab[:, 1:2] + 88) / 185
+    img_b_scale = (img_lab[:, 2:3] + 127) / 212
+    labels = torch.cat((img_a_scale, img_b_scale), dim=1).float()
 
     return input, labels
\ No newline at end of file
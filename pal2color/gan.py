@@ -1,25 +1,31 @@
 import torch
-from torch.autograd import Variable
 from .model import *
 from .global_hint import *
 from .data_loader import *
+from text2colors.amp import Precision
+from text2colors.profiling import Profiler
 
 def train(gm, images, pals, G, D, G_optimizer, D_optimizer, criterion_bce, 
         criterion_sL1, always_give_global_hint, add_L, gan_loss=0.1, isTrain=True):
 
-    D_loss = Variable(torch.zeros(1)).data
-    gm.image_process(images, pals, add_L, always_give_global_hint)
+    profiler = gm.profiler
+    with profiler.stage('image_process'):
+        gm.image_process(images, pals, always_give_global_hint, add_L)
 
+    # one G forward per step: D trains on a detached fake, G reuses the same activations
     gm.init(G, D)
-    gm.g_forward()
-    gm.d_forward(True)
-    D_loss = gm.d_backward(D_optimizer, criterion_bce, isTrain, gan_loss)
-
-    gm.init(G, D)
-    gm.g_forward()
-    gm.d_forward(False)
-    sL1_loss, G_loss = gm.g_backward(G_optimizer, D_optimizer,
-                    criterion_bce, criterion_sL1, isTrain, gan_loss)
+    with profiler.stage('g_forward'):
+        gm.g_forward()
+    with profiler.stage('d_forward'):
+        gm.d_forward(True)
+    with profiler.stage('d_backward'):
+        D_loss = gm.d_backward(D_optimizer, criterion_bce, isTrain, gan_loss)
+
+    with profiler.stage('d_forward_fake'):
+        gm.d_forward(False)
+    with profiler.stage('g_backward'):
+        sL1_loss, G_loss = gm.g_backward(G_optimizer, D_optimizer,
+                        criterion_bce, criterion_sL1, isTrain, gan_loss)
 
     output, ground_truth = gm.getImage()
 
@@ -30,6 +36,12 @@ def train(gm, images, pals, G, D, G_optimizer, D_optimizer, criterion_bce,
 
 class GanModel(nn.Module):
 
+    def __init__(self, device='cpu', precision=None, profiler=None):
+        super(GanModel, self).__init__()
+        self.device = torch.device(device)
+        self.precision = precision if precision is not None else Precision('none', device)
+        self.profiler = profiler if profiler is not None else Profiler(False, device)
+
     def init(self, unet, discriminator):
 
         self.fake_image = None
@@ -41,10 +53,17 @@ class GanModel(nn.Module):
 
     def image_process(self, images, pals, always_give_global_hint, add_L):
         
-        batch = images.size(0)
-        imsize = images.size(3)
+        if isinstance(images, (tuple, list)):
+            # already converted to Lab by lab_collate in the loader workers
+            inputs, labels = images
+            inputs = inputs.to(self.device, non_blocking=True).float()
+            labels = labels.to(self.device, non_blocking=True).float()
+        else:
+            images = images.to(self.device, non_blocking=True)
+            inputs, labels = process_data(images, images.size(0), images.size(3))
+        batch = inputs.size(0)
 
-        inputs, labels = process_data(images, batch, imsize)
+        pals = torch.as_tensor(pals).to(self.device, non_blocking=True)
         if add_L:
             for_global = process_palette_lab(pals, batch)
             global_hint = process_global_lab(for_global, batch, always_give_global_hint)
@@ -52,31 +71,33 @@ class GanModel(nn.Module):
             for_global = process_palette_ab(pals, batch)
             global_hint = process_global_ab(for_global, batch, always_give_global_hint)
 
-        self.L_image = Variable(inputs).cuda()
-        self.real_image = Variable(labels).cuda()
-        self.global_hint = Variable(global_hint).cuda()
+        self.L_image = inputs
+        self.real_image = labels
+        self.global_hint = global_hint
 
     def g_forward(self):
 
-        batch = self.global_hint.size(0)
-        self.fake_image = self.G(self.L_image, self.global_hint)
+        with self.precision.autocast():
+            self.fake_image = self.G(self.L_image, self.global_hint)
 
     def d_forward(self, isD):
         true = None
-        imsize = self.real_image.size(3)
-        global_hint = (self.global_hint).expand(-1,-1,imsize,imsize)
-        if isD:
-            true = self.D(torch.cat((self.real_image, global_hint), dim=1))
-        false = self.D(torch.cat((self.fake_image, global_hint), dim=1))
+        with self.precision.autocast():
+            if isD:
+                true = self.D(self.real_image, self.global_hint)
+                false = self.D(self.fake_image.detach(), self.global_hint)
+            else:
+                false = self.D(self.fake_image, self.global_hint)
 
-        self.true = true
-        self.false = false
+        # D returns logits; losses are computed in float32 outside autocast
+        self.true = true.float() if true is not None else None
+        self.false = false.float()
 
     def d_backward(self, D_optimizer, criterion_bce, isTrain, gan_loss):
 
         batch_size =  self.global_hint.size(0)
-        y_ones, y_zeros = (Variable(torch.ones(batch_size, 1), requires_grad=False).cuda(),
-                            Variable(torch.zeros(batch_size, 1), requires_grad=False).cuda())
+        y_ones, y_zeros = (torch.ones(batch_size, 1, device=self.device),
+                            torch.zeros(batch_size, 1, device=self.device))
 
         real_loss = criterion_bce(self.true, y_ones)
         fake_loss = criterion_bce(self.false, y_zeros)
@@ -85,20 +106,20 @@ class GanModel(nn.Module):
 
         if isTrain:
             D_optimizer.zero_grad()
-            loss.backward()
-            D_optimizer.step()
+            self.precision.backward(loss)
+            self.precision.step(D_optimizer)
 
-        return loss.data[0]
+        # detached device scalars: calling .item() here would wait for the step every iteration
+        return loss.detach()
 
     def g_backward(self, G_optimizer, D_optimizer,
                     criterion_bce, criterion_sL1, isTrain, gan_loss):
 
         batch_size = self.L_image.size(0)
-        G_loss = Variable(torch.zeros(1)).cuda()
-        y_ones = Variable(torch.ones(batch_size, 1), requires_grad=False).cuda()
+        y_ones = torch.ones(batch_size, 1, device=self.device)
         G_loss = gan_loss * criterion_bce(self.false, y_ones)
 
-        outputs = self.fake_image.view(batch_size, -1)
+        outputs = self.fake_image.float().view(batch_size, -1)
         labels = self.real_image.contiguous().view(batch_size, -1)
 
         sL1_loss = criterion_sL1(outputs, labels)
@@ -106,10 +127,11 @@ class GanModel(nn.Module):
 
         if isTrain:
             G_optimizer.zero_grad()
-            loss.backward()
-            G_optimizer.step()
+            self.precision.backward(loss)
+            self.precision.step(G_optimizer)
+            self.precision.update()
 
-        return sL1_loss.data[0], G_loss.data[0]
+        return sL1_loss.detach(), G_loss.detach()
 
     def getImage(self):
         if self.real_image is not None:
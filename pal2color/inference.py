@@ -0,0 +1,80 @@
+import math
+import torch
+import torch.nn.functional as F
+
+# UNet downsamples three times by 2, so inputs must be a multiple of 8
+STRIDE = 8
+# rough peak float32 activation footprint of a no_grad UNet forward, per input pixel
+BYTES_PER_PIXEL = 3072
+
+
+def pad_to_stride(x, stride=STRIDE):
+    h, w = x.shape[2:]
+    pad_h = (stride - h % stride) % stride
+    pad_w = (stride - w % stride) % stride
+    if pad_h or pad_w:
+        x = F.pad(x, (0, pad_w, 0, pad_h), mode='replicate')
+    return x
+
+
+def colorize(G, L_image, global_hint):
+    # any input size: pad to the network stride and crop the prediction back
+    h, w = L_image.shape[2:]
+    return G(pad_to_stride(L_image), global_hint)[:, :, :h, :w]
+
+
+def tile_size_for_budget(memory_budget, batch_size=1, stride=STRIDE):
+    side = int(math.sqrt(memory_budget / float(BYTES_PER_PIXEL * batch_size)))
+    return max(8 * stride, side // stride * stride)
+
+
+def _tile_starts(size, tile, step):
+    starts = list(range(0, max(size - tile, 0) + 1, step))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def _ramp(length, overlap, ramp_start, ramp_end, device):
+    weight = torch.ones(length, device=device)
+    ramp = (torch.arange(overlap, device=device, dtype=torch.float) + 1) / (overlap + 1)
+    if ramp_start:
+        weight[:overlap] = torch.min(weight[:overlap], ramp)
+    if ramp_end:
+        weight[length - overlap:] = torch.min(weight[length - overlap:], ramp.flip(0))
+    return weight
+
+
+def colorize_tiled(G, L_image, global_hint, tile_size=None, overlap=32, memory_budget=None):
+    """Colorizes large images through overlapping tiles with feathered seams.
+
+    The tile size is either given or derived from ``memory_budget`` (bytes of
+    activations per forward). Every tile sees the same global palette hint, and
+    overlapping predictions are blended with linear ramps. G must be in eval mode.
+    """
+    batch_size = L_image.size(0)
+    h, w = L_image.shape[2:]
+    if tile_size is None:
+        tile_size = tile_size_for_budget(memory_budget, batch_size) if memory_budget else 512
+    if h <= tile_size and w <= tile_size:
+        return colorize(G, L_image, global_hint)
+    if overlap >= tile_size:
+        raise ValueError("overlap (%d) must be smaller than tile_size (%d)" % (overlap, tile_size))
+
+    tile_h, tile_w = min(tile_size, h), min(tile_size, w)
+    step = tile_size - overlap
+    output = L_image.new_zeros(batch_size, 2, h, w)
+    weight = L_image.new_zeros(1, 1, h, w)
+
+    for top in _tile_starts(h, tile_h, step):
+        wy = _ramp(tile_h, overlap, top > 0, top + tile_h < h, L_image.device)
+        for left in _tile_starts(w, tile_w, step):
+            wx = _ramp(tile_w, overlap, left > 0, left + tile_w < w, L_image.device)
+            mask = (wy[:, None] * wx[None, :]).to(output.dtype)
+
+            tile = L_image[:, :, top:top + tile_h, left:left + tile_w]
+            pred = colorize(G, tile, global_hint)
+            output[:, :, top:top + tile_h, left:left + tile_w] += pred * mask
+            weight[:, :, top:top + tile_h, left:left + tile_w] += mask
+
+    return output / weight
@@ -0,0 +1,48 @@
+import torch
+
+# Same constants as skimage.color (sRGB primaries, D50 / 2-degree reference white),
+# so these match rgb2lab(..., illuminant='D50') and lab2rgb(..., illuminant='D50').
+XYZ_FROM_RGB = [[0.412453, 0.357580, 0.180423],
+                [0.212671, 0.715160, 0.072169],
+                [0.019334, 0.119193, 0.950227]]
+D50_WHITE = [0.96422, 1.0, 0.82521]
+
+
+def _matmul_channels(x, matrix):
+    # x: (..., 3), matrix: 3x3 applied to the last dim
+    matrix = torch.tensor(matrix, dtype=x.dtype, device=x.device)
+    return torch.matmul(x, matrix.t())
+
+
+def rgb2lab(rgb, dim=1):
+    rgb = rgb.movedim(dim, -1)
+    if not rgb.is_floating_point():
+        rgb = rgb.float()
+
+    linear = torch.where(rgb > 0.04045, ((rgb + 0.055) / 1.055).pow(2.4), rgb / 12.92)
+    xyz = _matmul_channels(linear, XYZ_FROM_RGB)
+    xyz = xyz / torch.tensor(D50_WHITE, dtype=xyz.dtype, device=xyz.device)
+
+    f = torch.where(xyz > 0.008856, xyz.clamp(min=0).pow(1.0 / 3), 7.787 * xyz + 16.0 / 116.0)
+    fx, fy, fz = f.unbind(-1)
+    lab = torch.stack((116.0 * fy - 16.0, 500.0 * (fx - fy), 200.0 * (fy - fz)), -1)
+    return lab.movedim(-1, dim)
+
+
+def lab2rgb(lab, dim=1):
+    lab = lab.movedim(dim, -1)
+    L, a, b = lab.unbind(-1)
+
+    fy = (L + 16.0) / 116.0
+    fx = a / 500.0 + fy
+    fz = (fy - b / 200.0).clamp(min=0)
+    f = torch.stack((fx, fy, fz), -1)
+
+    xyz = torch.where(f > 0.2068966, f.pow(3), (f - 16.0 / 116.0) / 7.787)
+    xyz = xyz * torch.tensor(D50_WHITE, dtype=xyz.dtype, device=xyz.device)
+
+    rgb_from_xyz = torch.linalg.inv(torch.tensor(XYZ_FROM_RGB, dtype=torch.float64))
+    linear = _matmul_channels(xyz, rgb_from_xyz.tolist())
+    rgb = torch.where(linear > 0.0031308,
+                      1.055 * linear.clamp(min=0).pow(1 / 2.4) - 0.055, linear * 12.92)
+    return rgb.clamp(0, 1).movedim(-1, dim)
@@ -1,8 +1,10 @@
+import torch
 import torch.nn as nn
-from torch.autograd import Variable
 from torch import optim
 import torch.optim.lr_scheduler as scheduler
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from contextlib import contextmanager, nullcontext
 
 from .util import *
 
@@ -256,26 +258,47 @@ class global_network(nn.Module):
         self.image_size = image_size
 
     def forward(self, x, dim):
-        n = 2
         out = self.oneD(x)
         
         if dim >= 256:
-            n = 4
             out = self.twoD(out)
         if dim == 512:
-            n = 8
             out = self.threeD(out)
             out = self.fourD(out)
 
-        out = out.repeat(1,1, int(self.image_size/n), int(self.image_size/n))
+        # (batch, C, 1, 1): broadcast over the feature map it is added to
         return out
 
 
+# UNet segments that can be recomputed in backward instead of keeping their
+# activations; block4, block8 and block9 include their global hint injection
+CHECKPOINT_BLOCKS = ('block4', 'block5', 'block6', 'block7', 'block8', 'block9')
+
+
+@contextmanager
+def frozen_bn_stats(module):
+    # a recomputed forward must not update the BatchNorm running statistics twice
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, tracked) in zip(bns, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(tracked)
+
+
 class UNet(nn.Module):
-    def __init__(self, imsize, multi_injection, add_L):
+    def __init__(self, imsize, multi_injection, add_L, checkpoint_blocks=()):
         super(UNet, self).__init__()
         self.imsize = imsize
         self.multi_injection = multi_injection
+        unknown = set(checkpoint_blocks) - set(CHECKPOINT_BLOCKS)
+        if unknown:
+            raise ValueError('unknown checkpoint blocks: %s' % ', '.join(sorted(unknown)))
+        self.checkpoint_blocks = set(checkpoint_blocks)
         self.globalnet512 = global_network(self.imsize, add_L)
 
         if multi_injection:
@@ -299,6 +322,27 @@ class UNet(nn.Module):
 
         self.prediction = prediction(128, 2)
 
+    def _block4(self, layer3, side_input):
+        return self.convlayer4(layer3) + self.globalnet512(side_input, 512)
+
+    def _block8(self, layer7, layer3_2, side_input):
+        layer8 = self.convlayer8(layer7, layer3_2)
+        if self.multi_injection:
+            layer8 = layer8 + self.globalnet256(side_input, 256)
+        return layer8
+
+    def _block9(self, layer8, layer2_2, side_input):
+        layer9 = self.convlayer9(layer8, layer2_2)
+        if self.multi_injection:
+            layer9 = layer9 + self.globalnet128(side_input, 128)
+        return layer9
+
+    def _run(self, name, fn, *inputs):
+        if name in self.checkpoint_blocks and torch.is_grad_enabled():
+            return checkpoint(fn, *inputs, use_reentrant=False,
+                              context_fn=lambda: (nullcontext(), frozen_bn_stats(self)))
+        return fn(*inputs)
+
     def forward(self, x, side_input):
         layer1_1 = self.convlayer1_1(x)
         layer1_2 = self.convlayer1_2(layer1_1)
@@ -307,24 +351,14 @@ class UNet(nn.Module):
         layer2_2 = self.convlayer2_2(layer1_2)
         layer3 = self.convlayer3(layer2)
         layer3_2 = self.convlayer3_2(layer2)
-        layer4 = self.convlayer4(layer3)
 
-        global_net512 = self.globalnet512(side_input, 512)
-        layer4 = layer4 + global_net512
-        layer5 = self.convlayer5(layer4)
-        layer6 = self.convlayer6(layer5)
-        layer7 = self.convlayer7(layer6)
+        layer4 = self._run('block4', self._block4, layer3, side_input)
+        layer5 = self._run('block5', self.convlayer5, layer4)
+        layer6 = self._run('block6', self.convlayer6, layer5)
+        layer7 = self._run('block7', self.convlayer7, layer6)
+        layer8 = self._run('block8', self._block8, layer7, layer3_2, side_input)
+        layer9 = self._run('block9', self._block9, layer8, layer2_2, side_input)
 
-        layer8 = self.convlayer8(layer7, layer3_2)
-        if self.multi_injection:
-            global_net256 = self.globalnet256(side_input, 256)
-            layer8 = layer8 + global_net256
-        
-        layer9 = self.convlayer9(layer8, layer2_2)
-        if self.multi_injection:
-            global_net128 = self.globalnet128(side_input, 128)
-            layer9 = layer9 + global_net128
-        
         layer10 = self.convlayer10(layer9, layer1_2_2)
 
         prediction = self.prediction(layer10)
@@ -355,27 +389,60 @@ class Discriminator(nn.Module):
         self.main = nn.Sequential(*layers)
         self.conv1 = nn.Conv2d(curr_dim, curr_dim, kernel_size=3, stride=1, padding=1, bias=False)
 
+        # returns logits; train with BCEWithLogitsLoss, which stays finite under autocast
         self.fc = nn.Sequential(
             nn.BatchNorm1d(k_size*k_size*curr_dim),
             nn.Linear(k_size*k_size*curr_dim, 1),
-            nn.Sigmoid(),
         )
 
-    def forward(self, x):
+    def forward(self, x, hint=None):
+        # x is either the image already concatenated with the tiled hint, or the
+        # image alone with the (batch, C, 1, 1) hint passed separately
         batch_size = x.size(0)
-        h = self.main(x)
+        if hint is None:
+            h = self.main(x)
+        else:
+            h = self.main[1:](self.hinted_conv(x, hint))
         out = self.conv1(h)
         out = out.view(batch_size, -1)
         out = self.fc(out)
         return out
 
+    def hinted_conv(self, x, hint):
+        # Same as main[0](cat(x, hint.expand(...))) without building the full-size
+        # hint map: a spatially constant input contributes (W_hint . hint) summed
+        # over the kernel taps that land inside the image, so only the zero-padded
+        # borders see fewer taps.
+        conv = self.main[0]
+        weight_x, weight_hint = conv.weight[:, :x.size(1)], conv.weight[:, x.size(1):]
+        out = F.conv2d(x, weight_x, conv.bias, conv.stride, conv.padding)
+
+        taps = torch.einsum('bc,ocyx->boyx', hint.flatten(1), weight_hint)
+        valid_y = _valid_taps(out.size(2), x.size(2), conv.kernel_size[0], conv.stride[0], conv.padding[0], out)
+        valid_x = _valid_taps(out.size(3), x.size(3), conv.kernel_size[1], conv.stride[1], conv.padding[1], out)
+        return out + torch.einsum('hy,boyx,wx->bohw', valid_y, taps, valid_x)
+
+
+def _valid_taps(out_size, in_size, kernel_size, stride, padding, like, dilation=1):
+    # (out_size, kernel_size): 1 where the tap reads inside the input, 0 on padding
+    pos = torch.arange(out_size, device=like.device).unsqueeze(1) * stride - padding \
+          + torch.arange(kernel_size, device=like.device).unsqueeze(0) * dilation
+    return ((pos >= 0) & (pos < in_size)).to(like.dtype)
+
+
+def _valid_taps_transposed(out_size, in_size, kernel_size, stride, padding, like, dilation=1):
+    # the same for a transposed conv: tap k of output o reads input (o + padding - k * dilation) / stride
+    pos = torch.arange(out_size, device=like.device).unsqueeze(1) + padding \
+          - torch.arange(kernel_size, device=like.device).unsqueeze(0) * dilation
+    return ((pos % stride == 0) & (pos >= 0) & (pos < in_size * stride)).to(like.dtype)
+
 
 def init_models(batch_size, imsize, dropout_ep, learning_rate, multi_injection, 
-                add_L, weight_decay=1e-7):
+                add_L, weight_decay=1e-7, device='cpu', checkpoint_blocks=()):
 
-    G = UNet(imsize, multi_injection, add_L).cuda()
+    G = UNet(imsize, multi_injection, add_L, checkpoint_blocks).to(device)
     print('# parameters of Generator : ',num_param(G))
-    D = Discriminator(add_L, imsize).cuda()
+    D = Discriminator(add_L, imsize).to(device)
     print('# parameters of Discriminator : ',num_param(D))
     G_optimizer = optim.Adam(G.parameters(), lr=learning_rate, weight_decay=weight_decay)
     D_optimizer = optim.Adam(D.parameters(), lr=learning_rate, weight_decay=weight_decay)
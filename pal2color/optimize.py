@@ -0,0 +1,190 @@
+import copy
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from pal2color.model import _valid_taps, _valid_taps_transposed
+
+
+def bn_affine(bn):
+    # eval-mode BatchNorm as a per-channel scale and shift
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    if bn.affine:
+        scale = scale * bn.weight
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        shift = shift + bn.bias
+    return scale.detach(), shift.detach()
+
+
+def fold_into_depthwise(bn, conv):
+    # bn -> depthwise 1x1 conv (no padding) is exactly one strided per-channel affine op
+    assert conv.groups == conv.in_channels == conv.out_channels and conv.kernel_size == (1, 1) \
+        and conv.padding == (0, 0)
+    scale, shift = bn_affine(bn)
+    folded = nn.Conv2d(conv.in_channels, conv.out_channels, 1, conv.stride, groups=conv.groups, bias=True)
+    weight = conv.weight.detach()
+    bias = weight.flatten() * shift
+    if conv.bias is not None:
+        bias = bias + conv.bias.detach()
+    folded.weight.data.copy_(weight * scale.view(-1, 1, 1, 1))
+    folded.bias.data.copy_(bias)
+    return folded.to(weight.device)
+
+
+def merge_convs(*convs):
+    # parallel convs over the same input as one conv; split its output with split_sizes
+    first = convs[0]
+    merged = nn.Conv2d(first.in_channels, sum(c.out_channels for c in convs), first.kernel_size,
+                       first.stride, first.padding, first.dilation, bias=first.bias is not None)
+    merged.weight.data.copy_(torch.cat([c.weight.detach() for c in convs], 0))
+    if first.bias is not None:
+        merged.bias.data.copy_(torch.cat([c.bias.detach() for c in convs], 0))
+    merged.split_sizes = [c.out_channels for c in convs]
+    return merged.to(first.weight.device)
+
+
+class FoldedConv(nn.Module):
+    """``conv(bn(x) + hint)`` with the BatchNorm folded into the conv weights.
+
+    The shift and the optional (batch, C, 1, 1) hint are spatially constant,
+    so their contribution is the conv response to a constant input: the sum of
+    the kernel taps that land inside the image. Only the zero-padded borders
+    see fewer taps, which keeps the fold exact.
+    """
+    def __init__(self, bn, conv, hinted=False):
+        super(FoldedConv, self).__init__()
+        scale, shift = bn_affine(bn)
+        self.transposed = isinstance(conv, nn.ConvTranspose2d)
+        self.conv = copy.deepcopy(conv)
+        weight = conv.weight.detach()
+        # Conv2d weights are (out, in, kh, kw), ConvTranspose2d weights (in, out, kh, kw)
+        self.spec = 'c,coyx->oyx' if self.transposed else 'c,ocyx->oyx'
+        in_shape = (-1, 1, 1, 1) if self.transposed else (1, -1, 1, 1)
+        self.conv.weight.data.copy_(weight * scale.view(in_shape))
+        self.register_buffer('shift_taps', torch.einsum(self.spec, shift, weight))
+        self.register_buffer('hint_weight', weight.clone() if hinted else None)
+
+    def valid_taps(self, out, x):
+        conv = self.conv
+        valid = _valid_taps_transposed if self.transposed else _valid_taps
+        return [valid(out.size(2 + d), x.size(2 + d), conv.kernel_size[d], conv.stride[d],
+                      conv.padding[d], out, conv.dilation[d]) for d in (0, 1)]
+
+    def forward(self, x, hint=None):
+        out = self.conv(x)
+        valid_y, valid_x = self.valid_taps(out, x)
+        taps = self.shift_taps.unsqueeze(0).to(out.dtype)
+        if hint is not None:
+            taps = taps + torch.einsum('b' + self.spec.replace('->', '->b'), hint.flatten(1).to(out.dtype),
+                                       self.hint_weight.to(out.dtype))
+        return out + torch.einsum('hy,boyw->bohw', valid_y, torch.einsum('boyx,wx->boyw', taps, valid_x))
+
+
+def _relu_convs(block, x, names):
+    for name in names:
+        x = F.relu(getattr(block, name)(x))
+    return x
+
+
+class InferenceUNet(nn.Module):
+    """An eval-only UNet with its BatchNorms folded away.
+
+    Built by ``optimize_for_inference`` from a trained UNet and numerically
+    equivalent to it in eval mode:
+
+    * the BNs of the downsampling blocks fold into their depthwise 1x1
+      stride-2 conv, so normalization and downsampling are one op at a quarter
+      of the resolution;
+    * every other BN folds into the conv that consumes it (``FoldedConv``),
+      together with the global hint added after blocks 4, 8 and 9;
+    * the parallel branches 1_2/1_2_2, 2/2_2 and 3/3_2 read the same input,
+      so their first convs run as one wider conv;
+    * the global network layers the UNet never reaches are dropped.
+    """
+    def __init__(self, G):
+        super(InferenceUNet, self).__init__()
+        G = copy.deepcopy(G).eval()
+        self.multi_injection = G.multi_injection
+
+        g = G.globalnet512
+        self.global512 = nn.Sequential(g.oneD, g.twoD, g.threeD, g.fourD)
+        if self.multi_injection:
+            self.global256 = nn.Sequential(G.globalnet256.oneD, G.globalnet256.twoD)
+            self.global128 = nn.Sequential(G.globalnet128.oneD)
+
+        self.conv1_1 = G.convlayer1_1.conv
+        self.conv1_2 = merge_convs(G.convlayer1_2.conv2, G.convlayer1_2_2.conv2)
+        self.down1 = fold_into_depthwise(G.convlayer1_2.batchnorm, G.convlayer1_2.conv3)
+
+        self.conv2 = merge_convs(G.convlayer2.conv, G.convlayer2_2.conv)
+        self.block2, self.block2_2 = G.convlayer2, G.convlayer2_2
+        self.down2 = fold_into_depthwise(G.convlayer2.batchnorm, G.convlayer2.conv3)
+
+        self.conv3 = merge_convs(G.convlayer3.conv, G.convlayer3_2.conv)
+        self.block3, self.block3_2 = G.convlayer3, G.convlayer3_2
+        self.down3 = fold_into_depthwise(G.convlayer3.batchnorm, G.convlayer3.conv4)
+
+        self.block4, self.block5, self.block6, self.block7 = G.convlayer4, G.convlayer5, G.convlayer6, G.convlayer7
+        self.block8, self.block9, self.block10 = G.convlayer8, G.convlayer9, G.convlayer10
+        self.in5 = FoldedConv(G.convlayer4.batchnorm, G.convlayer5.conv, hinted=True)
+        self.in6 = FoldedConv(G.convlayer5.batchnorm, G.convlayer6.conv)
+        self.in7 = FoldedConv(G.convlayer6.batchnorm, G.convlayer7.conv)
+        self.up8 = FoldedConv(G.convlayer7.batchnorm, G.convlayer8.up)
+        self.bridge8 = FoldedConv(G.convlayer3_2.batchnorm, G.convlayer8.bridge)
+        self.up9 = FoldedConv(G.convlayer8.batchnorm, G.convlayer9.up, hinted=self.multi_injection)
+        self.bridge9 = FoldedConv(G.convlayer2_2.batchnorm, G.convlayer9.bridge)
+        self.up10 = FoldedConv(G.convlayer9.batchnorm, G.convlayer10.up, hinted=self.multi_injection)
+        self.bridge10 = FoldedConv(G.convlayer1_2_2.batchnorm, G.convlayer10.bridge)
+        self.prediction = G.prediction.conv
+
+        # the folded or merged originals are no longer used
+        for block, names in ((self.block2, ('conv', 'conv3', 'batchnorm')),
+                             (self.block2_2, ('conv', 'batchnorm')),
+                             (self.block3, ('conv', 'conv4', 'batchnorm')),
+                             (self.block3_2, ('conv', 'batchnorm')),
+                             (self.block4, ('batchnorm',)),
+                             (self.block5, ('conv', 'batchnorm')),
+                             (self.block6, ('conv', 'batchnorm')),
+                             (self.block7, ('conv', 'batchnorm')),
+                             (self.block8, ('up', 'bridge', 'batchnorm')),
+                             (self.block9, ('up', 'bridge', 'batchnorm')),
+                             (self.block10, ('up', 'bridge'))):
+            for name in names:
+                delattr(block, name)
+        self.eval()
+
+    def forward(self, x, side_input):
+        a = F.relu(self.conv1_1(x))
+        pre1_2, pre1_2_2 = F.relu(self.conv1_2(a)).split(self.conv1_2.split_sizes, 1)
+        layer1_2 = self.down1(pre1_2)
+
+        pre2, pre2_2 = F.relu(self.conv2(layer1_2)).split(self.conv2.split_sizes, 1)
+        layer2 = self.down2(F.relu(self.block2.conv2(pre2)))
+        pre2_2 = F.relu(self.block2_2.conv2(pre2_2))
+
+        pre3, pre3_2 = F.relu(self.conv3(layer2)).split(self.conv3.split_sizes, 1)
+        layer3 = self.down3(_relu_convs(self.block3, pre3, ('conv2', 'conv3')))
+        pre3_2 = _relu_convs(self.block3_2, pre3_2, ('conv2', 'conv3'))
+
+        pre4 = _relu_convs(self.block4, layer3, ('conv', 'conv2', 'conv3'))
+        pre5 = _relu_convs(self.block5, F.relu(self.in5(pre4, self.global512(side_input))), ('conv2', 'conv3'))
+        pre6 = _relu_convs(self.block6, F.relu(self.in6(pre5)), ('conv2', 'conv3'))
+        pre7 = _relu_convs(self.block7, F.relu(self.in7(pre6)), ('conv2', 'conv3'))
+
+        hint256 = self.global256(side_input) if self.multi_injection else None
+        hint128 = self.global128(side_input) if self.multi_injection else None
+
+        out = F.relu(self.bridge8(pre3_2) + self.up8(pre7))
+        pre8 = _relu_convs(self.block8, out, ('conv', 'conv2'))
+        out = F.relu(self.bridge9(pre2_2) + self.up9(pre8, hint256))
+        pre9 = _relu_convs(self.block9, out, ('conv',))
+        out = F.relu(self.bridge10(pre1_2_2) + self.up10(pre9, hint128))
+        out = self.block10.activation2(self.block10.conv(out))
+
+        return torch.sigmoid(self.prediction(out))
+
+
+def optimize_for_inference(G):
+    # a folded copy of G for eval-mode inference; G itself is left untouched
+    return InferenceUNet(G)
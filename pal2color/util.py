@@ -6,6 +6,8 @@ import torch
 import warnings
 from skimage.color import rgb2lab, lab2rgb, rgb2gray
 
+from text2colors.checkpoint import list_checkpoints
+
 def check_value(inds, val):
     if (np.array(inds).size == 1):
         if (inds == val):
@@ -92,29 +94,36 @@ def num_param(model):
     return params
 
 def print_log(idx, num_idx, epoch, mini_batch, num_epochs, num_batches, sL1_loss, tell_time, iter):
+    # sL1_loss may be a device tensor; it is only copied to the host on the iterations that are printed
     if (mini_batch + 1) % 10 == 0:
         print('Epoch [%d/%d], IDX [%d/%d], Iter [%d/%d], sL1_loss: %.10f, iter_time: %2.2f, aggregate_time: %6.2f'
-              % (epoch + 1, num_epochs, idx, num_idx, mini_batch + 1, num_batches, sL1_loss,
+              % (epoch + 1, num_epochs, idx, num_idx, mini_batch + 1, num_batches, float(sL1_loss),
                  (tell_time.toc() - iter), tell_time.toc()))
         iter = tell_time.toc()
 
-def resume(resume_, log_path, dataset, G, G_optimizer, D, D_optimizer):
-    start_idx=1
+def resume(resume_, log_path, dataset, G, G_optimizer, D, D_optimizer, device='cpu', precision=None):
+    # returns the global step of the checkpoint as start_idx
+    start_idx=0
     start_epoch=0
     if resume_:
-        ckpt_path = os.path.join(log_path, dataset, 'ckpt/model_origin.ckpt')
-        if os.path.isfile(ckpt_path):
-            print("Loading checkpoint...")
-            checkpoint = torch.load(ckpt_path)
-            try:
-                start_idx = checkpoint['idx']
-            except:
-                start_idx = 0
+        ckpt_dir = os.path.join(log_path, dataset, 'ckpt')
+        checkpoints = list_checkpoints(ckpt_dir, 'model')
+        # fall back to the single files written by older versions
+        paths = [path for _, path in checkpoints[-1:]] + \
+                [os.path.join(ckpt_dir, name) for name in ('model.ckpt', 'model_origin.ckpt')]
+        paths = [path for path in paths if os.path.isfile(path)]
+        if paths:
+            print("Loading checkpoint %s..." % paths[0])
+            # older checkpoints pickle the argparse Namespace
+            checkpoint = torch.load(paths[0], map_location=device, weights_only=False)
+            start_idx = checkpoint.get('step', checkpoint.get('idx', 0))
             start_epoch = checkpoint['epoch']
             G.load_state_dict(checkpoint['G_state_dict'])
             G_optimizer.load_state_dict(checkpoint['G_optimizer'])
             D.load_state_dict(checkpoint['D_state_dict'])
             D_optimizer.load_state_dict(checkpoint['D_optimizer'])
+            if precision is not None:
+                precision.load_state_dict(checkpoint.get('precision'))
             print("Start training from epoch {}.".format(checkpoint['epoch']+1))
         else:
             print("Sorry, no checkpoint found.")
@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+import os
+import argparse
+import torch
+
+from text2pal.embedding import prepare_data
+from text2pal.data_loader import get_loader
+from text2pal.inference import PaletteGenerator
+from pal2color.data_loader import Color_Dataloader
+from pal2color.gan import GanModel
+from text2colors.pipeline import load_generator
+from text2colors.quantization import quantize_tpn, quantize_unet
+from text2colors.device import set_num_threads
+from text2colors.timing import timeit
+
+CPU = torch.device('cpu')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build int8 TPN/PCN models and report their accuracy and latency')
+    parser.add_argument('--tpn_dir', type=str, default=None, help='directory with encoder.pkl and decoder.pkl')
+    parser.add_argument('--pcn_path', type=str, default=None, help='generator checkpoint to quantize')
+    parser.add_argument('--data', type=str, default='bird256', choices=['imagenet', 'bird256'])
+    parser.add_argument('--imsize', type=int, default=256)
+    parser.add_argument('--multi_injection', type=int, default=1)
+    parser.add_argument('--add_L', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--calibration_batches', type=int, default=8, help='PCN batches used to calibrate')
+    parser.add_argument('--eval_batches', type=int, default=4, help='batches used to measure accuracy')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--out_dir', type=str, default='./pal2color/models/int8')
+    parser.add_argument('--num_threads', type=int, default=0)
+    return parser.parse_args()
+
+
+def report(name, metric, fp32_err, int8_err, delta, fp32_time, int8_time):
+    print('%4s %-22s %10.4f %10.4f %12.4f %10.2f %10.2f %8.2fx' % (
+        name, metric, fp32_err, int8_err, delta, fp32_time * 1e3, int8_time * 1e3, fp32_time / int8_time))
+
+
+def evaluate_tpn(args):
+    input_dict = prepare_data()
+    fp32 = PaletteGenerator.from_checkpoint(args.tpn_dir, input_dict)
+    int8 = PaletteGenerator(*quantize_tpn(fp32.encoder, fp32.decoder), input_dict=input_dict, device=CPU)
+    _, val_loader = get_loader(args.batch_size, input_dict)
+
+    errors = torch.zeros(3)
+    for i, (words_index, palettes, lengths) in enumerate(val_loader):
+        if i == args.eval_batches:
+            break
+        # the same seeded noise for both models, so only quantization differs
+        target = palettes.float().view(-1, 5, 3)
+        ref = fp32.generate_lab(words_index, lengths, 1, seed=i)[:, 0]
+        out = int8.generate_lab(words_index, lengths, 1, seed=i)[:, 0]
+        errors += torch.stack([(ref - target).abs().mean(), (out - target).abs().mean(), (out - ref).abs().mean()])
+    errors /= min(i + 1, args.eval_batches)
+
+    t_fp32 = timeit(lambda: fp32.generate_lab(words_index, lengths, 1, seed=0), CPU, args.repeat)
+    t_int8 = timeit(lambda: int8.generate_lab(words_index, lengths, 1, seed=0), CPU, args.repeat)
+    report('TPN', 'Lab L1 (palette)', *errors.tolist(), t_fp32, t_int8)
+
+
+def evaluate_pcn(args):
+    G = load_generator(args.pcn_path, args.imsize, args.multi_injection, args.add_L)
+    _, train_loader, _ = Color_Dataloader(args.data, args.batch_size)
+    gm = GanModel(CPU)
+
+    batches = []
+    for images, pals in train_loader:
+        if len(batches) == args.calibration_batches + args.eval_batches:
+            break
+        gm.image_process(images, pals, 1, args.add_L)
+        batches.append((gm.L_image, gm.global_hint, gm.real_image))
+    calibration, evaluation = batches[:args.calibration_batches], batches[args.calibration_batches:]
+
+    G_int8 = quantize_unet(G, [(L, hint) for L, hint, _ in calibration])
+
+    errors = torch.zeros(3)
+    with torch.no_grad():
+        for L, hint, ab in evaluation:
+            ref, out = G(L, hint), G_int8(L, hint)
+            errors += torch.stack([(ref - ab).abs().mean(), (out - ab).abs().mean(), (out - ref).abs().mean()])
+        errors /= len(evaluation)
+
+        L, hint, _ = evaluation[0]
+        t_fp32 = timeit(lambda: G(L, hint), CPU, args.repeat)
+        t_int8 = timeit(lambda: G_int8(L, hint), CPU, args.repeat)
+    report('PCN', 'ab L1 (image, 0-1)', *errors.tolist(), t_fp32, t_int8)
+
+    if not os.path.isdir(args.out_dir): os.makedirs(args.out_dir)
+    path = os.path.join(args.out_dir, 'G_int8.pt')
+    # TorchScript rather than a pickled module, so loading it runs no Python code from the file
+    torch.jit.save(torch.jit.script(G_int8), path)
+    with torch.no_grad():
+        diff = (load_generator(path)(L, hint) - G_int8(L, hint)).abs().max().item()
+    assert diff < 1e-5, 'the saved int8 model does not match: %g' % diff
+    print('Saved %s (load it with --pcn_path)' % path)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    set_num_threads(args.num_threads)
+    print('%4s %-22s %10s %10s %12s %10s %10s %8s' % ('', 'metric', 'fp32 err', 'int8 err', 'int8 vs fp32',
+                                                      'fp32 ms', 'int8 ms', 'speedup'))
+    if args.tpn_dir is not None:
+        evaluate_tpn(args)
+    if args.pcn_path is not None:
+        evaluate_pcn(args)
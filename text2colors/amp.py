@@ -0,0 +1,49 @@
+import torch
+
+AMP_DTYPES = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def add_amp_args(parser):
+    parser.add_argument('--amp', type=str, default='none', choices=sorted(AMP_DTYPES),
+                        help='autocast precision (bf16 also works on CPU; fp16 uses loss scaling)')
+    return parser
+
+
+class Precision(object):
+    """Autocast context plus gradient scaling for one training or inference run.
+
+    ``none`` keeps everything in float32. ``fp16`` scales the loss so small
+    gradients do not underflow; ``bf16`` has the float32 exponent range and
+    needs no scaling. Losses should be computed outside ``autocast()`` on
+    float32 inputs (BCE in particular is not autocast-safe).
+    """
+    def __init__(self, mode='none', device='cpu'):
+        self.mode = mode
+        self.dtype = AMP_DTYPES[mode]
+        self.device_type = torch.device(device).type
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.dtype is torch.float16)
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    def autocast(self):
+        # the dtype is ignored when disabled, but must still be one autocast accepts
+        return torch.autocast(self.device_type, dtype=self.dtype or torch.bfloat16, enabled=self.enabled)
+
+    def backward(self, loss, **kwargs):
+        self.scaler.scale(loss).backward(**kwargs)
+
+    def step(self, optimizer):
+        self.scaler.step(optimizer)
+
+    def update(self):
+        # once per iteration, after every optimizer has stepped
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state):
+        if state:
+            self.scaler.load_state_dict(state)
@@ -0,0 +1,117 @@
+import os
+import re
+import glob
+import threading
+from queue import Queue
+
+import torch
+
+
+def snapshot(state):
+    # detached CPU copies, so training can keep updating the originals in place
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+def list_checkpoints(ckpt_dir, prefix='model'):
+    # [(step, path)] sorted by step
+    pattern = re.compile(r'^%s-(\d+)\.ckpt$' % re.escape(prefix))
+    found = []
+    for path in glob.glob(os.path.join(ckpt_dir, '%s-*.ckpt' % prefix)):
+        match = pattern.match(os.path.basename(path))
+        if match:
+            found.append((int(match.group(1)), path))
+    return sorted(found)
+
+
+class CheckpointManager(object):
+    """Writes training checkpoints on a background thread.
+
+    ``save`` only copies the state to CPU and queues it; the writer thread
+    saves to a temporary file, fsyncs it and renames it into place, so a crash
+    never leaves a truncated checkpoint. Only the newest ``keep`` checkpoints
+    are kept. At most one snapshot waits behind the one being written.
+    """
+    def __init__(self, ckpt_dir, prefix='model', keep=3):
+        self.ckpt_dir = ckpt_dir
+        self.prefix = prefix
+        self.keep = keep
+        if not os.path.isdir(ckpt_dir): os.makedirs(ckpt_dir)
+
+        self.queue = Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def path(self, step):
+        return os.path.join(self.ckpt_dir, '%s-%08d.ckpt' % (self.prefix, step))
+
+    def save(self, state, step):
+        self._check()
+        self.queue.put((snapshot(state), step))
+
+    def latest(self):
+        checkpoints = list_checkpoints(self.ckpt_dir, self.prefix)
+        return checkpoints[-1][1] if checkpoints else None
+
+    def load_latest(self, map_location='cpu'):
+        path = self.latest()
+        if path is None:
+            return None
+        print("Loading checkpoint %s..." % path)
+        return torch.load(path, map_location=map_location)
+
+    def wait(self):
+        self.queue.join()
+        self._check()
+
+    def close(self, raise_errors=True):
+        # stops the writer; with raise_errors=False a failed write is only reported,
+        # so it cannot replace an exception that is already propagating
+        try:
+            self.wait()
+        except Exception as e:
+            if raise_errors:
+                raise
+            print("Checkpoint writer failed: %r" % e)
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, step = item
+            try:
+                self._write(state, self.path(step))
+                self._prune()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _prune(self):
+        checkpoints = list_checkpoints(self.ckpt_dir, self.prefix)
+        for _, path in checkpoints[:max(len(checkpoints) - self.keep, 0)]:
+            os.remove(path)
@@ -0,0 +1,100 @@
+import os
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from text2colors.device import set_num_threads
+
+# nchw: eager, default layout; channels_last: eager, NHWC activations and weights;
+# prepack: channels_last, traced and frozen so the conv weights are pre-packed for oneDNN
+CPU_MODES = ('nchw', 'channels_last', 'prepack')
+
+
+def worker_threads(num_workers=1, worker_id=None):
+    """Gives this process its share of the machine's cores.
+
+    Each of ``num_workers`` inference workers gets an equal number of intra-op
+    threads and one inter-op thread; a UNet forward has no independent ops to
+    overlap. With a ``worker_id`` on Linux the process is also pinned to its
+    own cores. Call it at startup, before any parallel work.
+    """
+    if num_workers < 1:
+        raise ValueError('num_workers must be at least 1, got %d' % num_workers)
+    if worker_id is not None and not 0 <= worker_id < num_workers:
+        raise ValueError('worker_id must be in [0, %d), got %d' % (num_workers, worker_id))
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    share = max(1, len(cores) // num_workers)
+    if worker_id is not None and hasattr(os, 'sched_setaffinity'):
+        # with more workers than cores, workers share cores round-robin
+        start = (worker_id * share) % len(cores)
+        os.sched_setaffinity(0, cores[start:start + share])
+    set_num_threads(share, 1)
+    return share
+
+
+def tune_threads(fn, candidates=None, repeat=5):
+    # times fn for each intra-op thread count and keeps the fastest; returns (best, {threads: seconds})
+    if candidates is None:
+        n = torch.get_num_threads()
+        candidates = sorted({max(1, n >> i) for i in range(4)})
+    timings = {}
+    for num_threads in candidates:
+        torch.set_num_threads(num_threads)
+        fn()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        timings[num_threads] = (time.perf_counter() - start) / repeat
+    best = min(timings, key=timings.get)
+    torch.set_num_threads(best)
+    return best, timings
+
+
+class CPUGenerator(nn.Module):
+    """A PCN generator prepared for CPU inference in one of ``CPU_MODES``.
+
+    Inputs are converted to channels-last on the way in and outputs back to
+    contiguous NCHW, so it is a drop-in replacement for the generator.
+    ``prepack`` traces and freezes the model with
+    torch.jit.optimize_for_inference on the first input of each image size: a
+    trace keeps the shapes it saw (the border taps of the folded convs, for
+    one), so it is only reused at that size. The last ``max_traced`` sizes
+    are kept.
+    """
+    def __init__(self, G, mode='channels_last', max_traced=8):
+        super(CPUGenerator, self).__init__()
+        if mode not in CPU_MODES:
+            raise ValueError('unknown CPU mode %r' % mode)
+        self.channels_last = mode != 'nchw'
+        self.prepack = mode == 'prepack'
+        G = G.eval()
+        if self.channels_last:
+            G = G.to(memory_format=torch.channels_last)
+        self.G = G
+        self.max_traced = max_traced
+        self.traced = OrderedDict()
+
+    def convert(self, x):
+        return x.contiguous(memory_format=torch.channels_last) if self.channels_last else x
+
+    def trace(self, L, hint):
+        key = tuple(L.shape[2:])
+        if key in self.traced:
+            self.traced.move_to_end(key)
+        else:
+            with torch.no_grad():
+                self.traced[key] = torch.jit.optimize_for_inference(
+                    torch.jit.freeze(torch.jit.trace(self.G, (L[:1], hint[:1]))))
+            if len(self.traced) > self.max_traced:
+                self.traced.popitem(last=False)
+        return self.traced[key]
+
+    def forward(self, L, hint):
+        L = self.convert(L)
+        G = self.trace(L, hint) if self.prepack else self.G
+        return G(L, hint).contiguous()
@@ -0,0 +1,42 @@
+import torch
+
+
+def add_device_args(parser):
+    parser.add_argument('--device', type=str, default=None,
+                        help='cpu, cuda or cuda:N (default: cuda if available, else cpu)')
+    parser.add_argument('--num_threads', type=int, default=0,
+                        help='intra-op CPU threads (default: 0, let torch decide)')
+    parser.add_argument('--num_interop_threads', type=int, default=0,
+                        help='inter-op CPU threads (default: 0, let torch decide)')
+    return parser
+
+
+def get_device(device=None, gpu=0):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+
+    if device.type == 'cuda':
+        if device.index is None:
+            device = torch.device('cuda', gpu)
+        torch.cuda.set_device(device)
+    return device
+
+
+def set_num_threads(num_threads=0, num_interop_threads=0):
+    # inter-op threads can only be set before the first parallel region runs
+    if num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def setup_device(args):
+    set_num_threads(args.num_threads, args.num_interop_threads)
+    device = get_device(args.device, args.gpu)
+
+    if device.type == 'cuda':
+        print("Running on GPU : ", device.index)
+    else:
+        print("Running on CPU with %d threads" % torch.get_num_threads())
+    return device
@@ -0,0 +1,98 @@
+import os
+import warnings
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+
+def add_distributed_args(parser):
+    parser.add_argument('--world_size', type=int, default=1,
+                        help='training processes to spawn on this machine, 1 disables DDP (ignored under torchrun)')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'])
+    parser.add_argument('--dist_url', type=str, default='tcp://127.0.0.1:29500',
+                        help='rendezvous address for spawned processes')
+    parser.add_argument('--sync_bn', type=int, default=0,
+                        help='synchronize BatchNorm statistics across processes (CUDA only, use with nccl)')
+    return parser
+
+
+def launch(fn, args):
+    """Runs ``fn(args)`` in every training process.
+
+    Under torchrun the rank comes from the environment; otherwise
+    ``--world_size`` processes are spawned on this machine, or ``fn`` simply
+    runs in the current process when it is 1.
+    """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        args.rank = int(os.environ['RANK'])
+        args.world_size = int(os.environ['WORLD_SIZE'])
+        args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        args.local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', args.world_size))
+        args.dist_url = 'env://'
+        fn(args)
+    elif args.world_size > 1:
+        args.local_world_size = args.world_size
+        mp.spawn(_spawned, args=(fn, args), nprocs=args.world_size)
+    else:
+        args.rank = args.local_rank = 0
+        args.local_world_size = 1
+        fn(args)
+
+
+def _spawned(local_rank, fn, args):
+    args.rank = args.local_rank = local_rank
+    fn(args)
+
+
+def init_distributed(args):
+    # returns True when this process is part of a DDP group
+    if args.world_size <= 1:
+        return False
+    # processes sharing a machine split its cores unless told otherwise
+    if getattr(args, 'num_threads', 0) == 0:
+        args.num_threads = max(1, (os.cpu_count() or 1) // args.local_world_size)
+    dist.init_process_group(args.dist_backend, init_method=args.dist_url,
+                            world_size=args.world_size, rank=args.rank)
+    return True
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def wrap_ddp(model, device, sync_bn=False, **kwargs):
+    # kwargs go to DistributedDataParallel
+    if not dist.is_initialized():
+        return model
+    device = torch.device(device)
+    if sync_bn:
+        # SyncBatchNorm only trains on GPU tensors
+        if device.type != 'cuda':
+            raise ValueError('--sync_bn needs CUDA devices; drop it for CPU training')
+        if dist.get_backend() != 'nccl':
+            warnings.warn('--sync_bn is meant for the nccl backend, not %s' % dist.get_backend())
+        # replaces the BatchNorm children in place and keeps their parameters
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids, **kwargs)
+
+
+def wrap_pcn(G, D, device, sync_bn=False):
+    # returns the (G, D) to train with; both are unchanged without a process group
+    # globalnet256 and globalnet128 own layers the UNet forward never reaches
+    G = wrap_ddp(G, device, sync_bn, find_unused_parameters=True)
+    # D runs on real and fake images before one backward; broadcasting rank 0's
+    # BatchNorm buffers before each forward would change them in place between the two
+    D = wrap_ddp(D, device, sync_bn, broadcast_buffers=False)
+    return G, D
+
+
+def unwrap(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
@@ -0,0 +1,126 @@
+import pickle
+import zipfile
+import torch
+
+from text2pal.inference import PaletteGenerator, rgb2hex
+from pal2color.model import UNet
+from pal2color.data_loader import process_data, process_palette_lab, process_palette_ab
+from pal2color.global_hint import process_global_sampling_lab, process_global_sampling_ab
+from pal2color.inference import colorize_tiled
+from pal2color.optimize import optimize_for_inference
+from pal2color import lab
+from text2colors.amp import Precision
+from text2colors.cpu import CPUGenerator
+from text2colors.profiling import Profiler
+
+
+def is_torchscript(path):
+    # TorchScript archives carry a constants.pkl next to the weights
+    if not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as f:
+        return any(name.split('/')[-1] == 'constants.pkl' for name in f.namelist())
+
+
+def load_generator(pcn_path, imsize=256, multi_injection=1, add_L=1, device='cpu', optimize=False):
+    # TorchScript (the int8 model written by quantize.py) or weights we wrote ourselves;
+    # neither unpickles arbitrary Python objects
+    if is_torchscript(pcn_path):
+        return torch.jit.load(pcn_path, map_location=device).eval()
+    try:
+        state = torch.load(pcn_path, map_location='cpu', weights_only=True)
+    except pickle.UnpicklingError as e:
+        raise ValueError('%s is neither TorchScript nor a state_dict; int8 models pickled by older '
+                         'versions of quantize.py must be rebuilt with it (%s)' % (pcn_path, e))
+
+    G = UNet(imsize, multi_injection, add_L)
+    # accept both the per-epoch G state_dict and the full training checkpoint
+    if 'G_state_dict' in state:
+        state = state['G_state_dict']
+    G.load_state_dict(state)
+    G = G.to(device).eval()
+    return optimize_for_inference(G) if optimize else G
+
+
+class Text2Colors(object):
+    """Text -> palette (TPN) -> colorized image (PCN), with both models loaded once.
+
+    Requests are processed ``batch_size`` at a time through both stages and the
+    palette is handed from the TPN to the PCN as a device tensor. Images of any
+    size are accepted; those larger than ``tile_size`` (or than what fits in
+    ``memory_budget`` bytes) are colorized in overlapping tiles. On CPU,
+    ``cpu_mode`` selects the generator's memory format (see text2colors.cpu).
+    An enabled ``profiler`` records each stage and each generator block.
+    """
+    def __init__(self, palette_generator, G, add_L=1, batch_size=16,
+                 tile_size=None, overlap=32, memory_budget=None, amp='none', cpu_mode='nchw',
+                 profiler=None):
+        self.tpn = palette_generator
+        self.G = G.eval()
+        if cpu_mode != 'nchw':
+            if palette_generator.device.type != 'cpu':
+                raise ValueError('cpu_mode %r needs the models on CPU' % cpu_mode)
+            self.G = CPUGenerator(self.G, cpu_mode)
+        self.add_L = add_L
+        self.batch_size = batch_size
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.memory_budget = memory_budget
+        # quantized generators keep their weights outside parameters()
+        self.device = palette_generator.device
+        self.precision = Precision(amp, self.device)
+        self.profiler = profiler if profiler is not None else Profiler(False, self.device)
+        if not isinstance(self.G, CPUGenerator):
+            self.profiler.watch(self.G, 'G')
+        elif not self.G.prepack:
+            # a prepacked generator runs traced graphs, which take no Python hooks
+            self.profiler.watch(self.G.G, 'G')
+
+    @classmethod
+    def from_checkpoints(cls, tpn_dir, pcn_path, input_dict, imsize=256, multi_injection=1,
+                         add_L=1, batch_size=16, device='cpu', amp='none', int8=False, optimize=False, **kwargs):
+        tpn = PaletteGenerator.from_checkpoint(tpn_dir, input_dict, device=device, amp=amp, int8=int8,
+                                               profiler=kwargs.get('profiler'))
+        G = load_generator(pcn_path, imsize, multi_injection, add_L, device, optimize)
+        return cls(tpn, G, add_L, batch_size, amp=amp, **kwargs)
+
+    def global_hint(self, pal_lab):
+        # (batch, 5, 3) Lab palettes -> (batch, 16 or 11, 1, 1) PCN hint
+        batch = pal_lab.size(0)
+        if self.add_L:
+            for_global = process_palette_lab(pal_lab, batch)
+            return process_global_sampling_lab(for_global, batch, None, None, None, self.device)
+        for_global = process_palette_ab(pal_lab, batch)
+        return process_global_sampling_ab(for_global, batch, None, None, None, self.device)
+
+    def colorize(self, images, pal_lab):
+        # images: (batch, 3 or 1, H, W) RGB/gray in [0, 1] or uint8; returns RGB in [0, 1]
+        profiler = self.profiler
+        with profiler.stage('process_data'):
+            images = torch.as_tensor(images).to(self.device)
+            if images.size(1) == 1:
+                images = images.expand(-1, 3, -1, -1)
+            L_image, _ = process_data(images, images.size(0), images.size(3))
+
+        with profiler.stage('pcn'), torch.no_grad(), self.precision.autocast():
+            ab = colorize_tiled(self.G, L_image, self.global_hint(pal_lab.to(self.device)),
+                                self.tile_size, self.overlap, self.memory_budget)
+        ab = ab.float()
+
+        with profiler.stage('lab2rgb'):
+            img_lab = torch.cat((L_image * 100, ab[:, 0:1] * 185 - 88, ab[:, 1:2] * 212 - 127), dim=1)
+            return lab.lab2rgb(img_lab, dim=1)
+
+    def __call__(self, texts, images, seed=None):
+        palettes, outputs = [], []
+        for start in range(0, len(texts), self.batch_size):
+            end = start + self.batch_size
+            with self.profiler.stage('tokenize'):
+                words_index, lengths = self.tpn.tokenize(texts[start:end])
+            pal_lab = self.tpn.generate_lab(words_index, lengths, 1, seed)[:, 0]
+
+            outputs.append(self.colorize(images[start:end], pal_lab))
+            pal_rgb = lab.lab2rgb(pal_lab.double(), dim=-1).cpu()
+            palettes.extend([[rgb2hex(color) for color in palette] for palette in pal_rgb.tolist()])
+
+        return {'palettes': palettes, 'images': torch.cat(outputs, 0)}
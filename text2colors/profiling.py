@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile', type=int, default=0,
+                        help='record per-stage and per-UNet-block timings (synchronizes CUDA at stage boundaries)')
+    parser.add_argument('--profile_dir', type=str, default='./profile',
+                        help='where the Chrome trace and the timing summary are written')
+    parser.add_argument('--profile_interval', type=int, default=100,
+                        help='steps between printed timing summaries')
+    parser.add_argument('--profile_window', type=int, default=1000,
+                        help='recent calls per stage used for the percentiles')
+    return parser
+
+
+class LatencyStats(object):
+    def __init__(self, window=10000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self, qs=(50, 90, 99)):
+        if not self.samples:
+            return {}
+        values = np.percentile(np.asarray(self.samples) * 1e3, qs)
+        return {'p%d_ms' % q: float(v) for q, v in zip(qs, values)}
+
+    def info(self):
+        info = {'count': self.count}
+        info.update(self.percentiles())
+        return info
+
+
+class Profiler(object):
+    """Opt-in wall-clock timings of named stages, with rolling percentiles.
+
+    ``stage(name)`` times a block, ``iterate(loader)`` times the wait for each
+    batch and ``watch(model)`` times the forward of each of its child modules
+    (the UNet blocks). On CUDA the device is synchronized at every boundary so
+    a stage is charged for its own kernels; this slows the run down, which is
+    why it is off unless ``enabled``. A disabled profiler does nothing.
+
+    Every call is also kept as a Chrome trace event (up to ``max_events``);
+    ``export`` writes them for chrome://tracing or Perfetto, together with a
+    JSON summary of the percentiles.
+    """
+    def __init__(self, enabled=False, device='cpu', window=1000, max_events=200000):
+        self.enabled = enabled
+        self.sync = enabled and torch.device(device).type == 'cuda'
+        self.window = window
+        self.stats = {}
+        self.events = deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        # the server reads the summary on its event loop while batches run on a worker thread
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args, device='cpu'):
+        return cls(getattr(args, 'profile', 0), device, getattr(args, 'profile_window', 1000))
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def record(self, name, start, end):
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = LatencyStats(self.window)
+            self.stats[name].add(end - start)
+            self.events.append({'name': name, 'ph': 'X', 'pid': self.pid, 'tid': threading.get_ident(),
+                                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6})
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = self._now()
+        # the same label shows up in torch.profiler traces
+        with torch.profiler.record_function(name):
+            yield
+        self.record(name, start, self._now())
+
+    def iterate(self, iterable, name='data'):
+        # yields from iterable, timing how long each item took to arrive
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def watch(self, model, prefix=None):
+        # times the forward of every child module; returns the hook handles
+        if not self.enabled or isinstance(model, torch.jit.ScriptModule):
+            # script modules (the prepacked CPU generator) take no Python hooks
+            return []
+        prefix = prefix or type(model).__name__
+        starts = {}
+        handles = []
+        for name, module in model.named_children():
+            label = '%s/%s' % (prefix, name)
+
+            def pre_hook(module, inputs, label=label):
+                starts[label] = self._now()
+
+            def hook(module, inputs, output, label=label):
+                # a checkpoint recompute may stop inside a block without reaching its forward hook
+                start = starts.pop(label, None)
+                if start is not None:
+                    self.record(label, start, self._now())
+
+            handles.append(module.register_forward_pre_hook(pre_hook))
+            handles.append(module.register_forward_hook(hook))
+        return handles
+
+    def summary(self):
+        # {stage: {count, mean_ms, p50_ms, p90_ms, p99_ms}} over the recent window
+        summary = {}
+        with self.lock:
+            for name, stats in sorted(self.stats.items()):
+                info = stats.info()
+                info['mean_ms'] = float(np.mean(stats.samples)) * 1e3
+                summary[name] = info
+        return summary
+
+    def report(self):
+        lines = ['%-32s %8s %10s %10s %10s %10s' % ('stage', 'count', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms')]
+        for name, info in self.summary().items():
+            lines.append('%-32s %8d %10.3f %10.3f %10.3f %10.3f' % (
+                name, info['count'], info['mean_ms'], info['p50_ms'], info['p90_ms'], info['p99_ms']))
+        return '\n'.join(lines)
+
+    def export(self, out_dir, prefix='profile'):
+        # writes <prefix>_trace.json (Chrome trace) and <prefix>_summary.json; returns their paths
+        if not self.enabled:
+            return None
+        if not os.path.isdir(out_dir): os.makedirs(out_dir)
+        trace_path = os.path.join(out_dir, prefix + '_trace.json')
+        summary_path = os.path.join(out_dir, prefix + '_summary.json')
+        with self.lock:
+            events = list(self.events)
+        with open(trace_path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        with open(summary_path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        return trace_path, summary_path
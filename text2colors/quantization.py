@@ -0,0 +1,50 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def set_quantized_engine():
+    # x86 (fbgemm) kernels support the broadcast hint additions; qnnpack is the ARM fallback
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError('this torch build has no quantized CPU engine')
+
+
+def quantize_tpn(encoder, decoder):
+    """Dynamically quantized int8 copies of a TPN encoder and decoder.
+
+    GRU and Linear weights (including the decoder's Attn and the CA net) are
+    stored as int8 and activations are quantized on the fly, so no calibration
+    is needed. The models run on CPU only.
+    """
+    set_quantized_engine()
+    layers = {nn.GRU, nn.Linear}
+    encoder = quantize_dynamic(copy.deepcopy(encoder).cpu().eval(), layers, dtype=torch.qint8)
+    decoder = quantize_dynamic(copy.deepcopy(decoder).cpu().eval(), layers, dtype=torch.qint8)
+    return encoder, decoder
+
+
+def quantize_unet(G, calibration):
+    """Statically quantized int8 copy of a PCN generator.
+
+    ``calibration`` yields ``(L, global_hint)`` batches that are run through
+    the observed model to choose activation ranges. Inputs and outputs of the
+    returned model stay float32, and it runs on CPU only.
+    """
+    engine = set_quantized_engine()
+    G = copy.deepcopy(G).cpu().eval()
+    G.checkpoint_blocks = set()
+
+    calibration = iter(calibration)
+    L, hint = next(calibration)
+    prepared = prepare_fx(G, get_default_qconfig_mapping(engine), (L, hint))
+    with torch.no_grad():
+        prepared(L, hint)
+        for L, hint in calibration:
+            prepared(L, hint)
+    return convert_fx(prepared)
@@ -0,0 +1,349 @@
+#! /usr/bin/env python
+import json
+import time
+import base64
+import binascii
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from text2colors.device import add_device_args, setup_device
+from text2colors.amp import add_amp_args
+from text2colors.cpu import CPU_MODES, worker_threads
+from text2colors.profiling import LatencyStats, Profiler, add_profile_args
+from text2colors.pipeline import Text2Colors, load_generator
+from text2pal.embedding import prepare_data
+from text2pal.inference import PaletteGenerator
+from text2pal.cache import PaletteCache
+
+
+class Overloaded(Exception):
+    pass
+
+
+class MicroBatcher(object):
+    """Groups concurrent requests into batches for a blocking batch function.
+
+    A batch is dispatched when ``max_batch_size`` requests are waiting or
+    ``max_wait_ms`` after its first request arrived, and runs on ``executor``
+    so the event loop keeps accepting requests. When ``max_queue`` requests are
+    already waiting, new ones are rejected with Overloaded.
+    """
+    def __init__(self, batch_fn, executor, max_batch_size=16, max_wait_ms=5, max_queue=256):
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue = max_queue
+        self.queue = None
+        self.task = None
+        self.latency = LatencyStats()
+        self.batch_sizes = LatencyStats()
+        self.rejected = 0
+        self.timed_out = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.task = asyncio.ensure_future(self._run())
+
+    async def submit(self, item, timeout=None):
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((item, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            # the batch loop skips requests whose future is already cancelled
+            future.cancel()
+            self.timed_out += 1
+            raise
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return [entry for entry in batch if not entry[1].cancelled()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+            self.batch_sizes.add(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_fn,
+                                                     [item for item, _, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+
+            now = time.perf_counter()
+            for (_, future, start), result in zip(batch, results):
+                if future.cancelled():
+                    continue
+                self.latency.add(now - start)
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def info(self):
+        return {'latency': self.latency.info(),
+                'mean_batch_size': float(np.mean(self.batch_sizes.samples)) if self.batch_sizes.samples else 0.0,
+                'queued': self.queue.qsize() if self.queue is not None else 0,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out}
+
+
+def palette_batch(tpn):
+    def run(items):
+        # one model call per (num_samples, seed) group
+        results = [None] * len(items)
+        groups = {}
+        for i, item in enumerate(items):
+            # a prompt with no known words fails alone, not the requests batched with it
+            try:
+                tpn.token_ids([item['text']])
+            except ValueError as e:
+                results[i] = e
+                continue
+            groups.setdefault((item.get('num_samples', 1), item.get('seed')), []).append(i)
+        for (num_samples, seed), idxs in groups.items():
+            # only model errors are left, and they fail just this group; route maps them to 500
+            try:
+                out = tpn.generate([items[i]['text'] for i in idxs], num_samples, seed)
+            except Exception as e:
+                for i in idxs:
+                    results[i] = e
+                continue
+            for j, i in enumerate(idxs):
+                results[i] = {'hex': out['hex'][j], 'lab': out['lab'][j].tolist()}
+        return results
+    return run
+
+
+def decode_image(item):
+    shape = item['shape']
+    image = np.frombuffer(base64.b64decode(item['image']), dtype=np.uint8).reshape(shape)
+    return torch.from_numpy(image.copy()).permute(2, 0, 1)
+
+
+def encode_image(image):
+    image = (image.clamp(0, 1) * 255).round().byte().permute(1, 2, 0).cpu().numpy()
+    return {'image': base64.b64encode(image.tobytes()).decode('ascii'), 'shape': list(image.shape)}
+
+
+def colorize_batch(pipeline):
+    def run(items):
+        # group by (size, seed) since a UNet batch needs a single image size
+        results = [None] * len(items)
+        images = {}
+        groups = {}
+        for i, item in enumerate(items):
+            # bad text or image data fails only its own request
+            try:
+                pipeline.tpn.token_ids([item['text']])
+                images[i] = decode_image(item)
+            except (ValueError, TypeError, binascii.Error) as e:
+                results[i] = ValueError('bad request: %s' % e)
+                continue
+            groups.setdefault((tuple(images[i].shape), item.get('seed')), []).append(i)
+        for (_, seed), idxs in groups.items():
+            try:
+                out = pipeline([items[i]['text'] for i in idxs], torch.stack([images[i] for i in idxs]), seed)
+            except Exception as e:
+                for i in idxs:
+                    results[i] = e
+                continue
+            for j, i in enumerate(idxs):
+                result = encode_image(out['images'][j])
+                result['palette'] = out['palettes'][j]
+                results[i] = result
+        return results
+    return run
+
+
+def check_number(item, key, kind, low, high):
+    value = item.get(key)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, kind) or not low <= value <= high):
+        raise ValueError('%s must be a number in [%s, %s]' % (key, low, high))
+
+
+class Server(object):
+    """HTTP front end for the batchers.
+
+    Requests are validated before they are queued: ``num_samples`` is capped
+    at ``max_samples``, client timeouts at ``max_timeout`` seconds and bodies
+    at ``max_body_bytes``.
+    """
+    def __init__(self, batchers, timeout=10.0, cache=None, profiler=None, max_samples=16,
+                 max_timeout=60.0, max_body_bytes=16 * 2**20):
+        self.batchers = batchers
+        self.timeout = timeout
+        self.cache = cache
+        self.profiler = profiler
+        self.max_samples = max_samples
+        self.max_timeout = max_timeout
+        self.max_body_bytes = max_body_bytes
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if not 0 <= length <= self.max_body_bytes:
+                status, payload = 413, {'error': 'the request body must be at most %d bytes' % self.max_body_bytes}
+            else:
+                body = await reader.readexactly(length)
+                status, payload = await self.route(request_line, body)
+        except (ValueError, IndexError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {'error': str(e)}
+        except Exception as e:
+            # always answer, rather than dropping the connection
+            status, payload = 500, {'error': repr(e)}
+
+        data = json.dumps(payload).encode('utf-8')
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                      'Connection: close\r\n\r\n' % (status, STATUS[status], len(data))).encode('latin-1'))
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+
+    async def route(self, request_line, body):
+        method, path = request_line[0], request_line[1]
+        if method == 'GET' and path == '/stats':
+            stats = {name: batcher.info() for name, batcher in self.batchers.items()}
+            if self.cache is not None:
+                stats['cache'] = self.cache.info()
+            if self.profiler is not None and self.profiler.enabled:
+                stats['profile'] = self.profiler.summary()
+            return 200, stats
+        name = path.strip('/')
+        if method != 'POST' or name not in self.batchers:
+            return 404, {'error': 'unknown endpoint %s %s' % (method, path)}
+
+        item = json.loads(body.decode('utf-8'))
+        if not isinstance(item, dict):
+            return 400, {'error': 'the request body must be a JSON object'}
+        missing = [key for key in REQUIRED[name] if key not in item]
+        if missing:
+            return 400, {'error': 'missing fields: %s' % ', '.join(missing)}
+        if not isinstance(item['text'], str):
+            return 400, {'error': 'text must be a string'}
+        check_number(item, 'num_samples', int, 1, self.max_samples)
+        check_number(item, 'seed', int, 0, 2**63 - 1)
+        check_number(item, 'timeout', (int, float), 0, self.max_timeout)
+        try:
+            return 200, await self.batchers[name].submit(item, item.get('timeout', self.timeout))
+        except Overloaded:
+            return 503, {'error': 'server overloaded, retry later'}
+        except asyncio.TimeoutError:
+            return 504, {'error': 'request timed out'}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': repr(e)}
+
+    async def serve(self, host, port):
+        for batcher in self.batchers.values():
+            batcher.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving on http://%s:%d" % (host, port))
+        async with server:
+            await server.serve_forever()
+
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+          500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+REQUIRED = {'palette': ['text'], 'colorize': ['text', 'image', 'shape']}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve TPN/PCN inference over HTTP')
+    parser.add_argument('--tpn_dir', type=str, required=True, help='directory with encoder.pkl and decoder.pkl')
+    parser.add_argument('--pcn_path', type=str, default=None, help='generator checkpoint; enables /colorize')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=16)
+    parser.add_argument('--max_wait_ms', type=float, default=5)
+    parser.add_argument('--max_queue', type=int, default=256)
+    parser.add_argument('--timeout', type=float, default=10.0, help='default per-request timeout in seconds')
+    parser.add_argument('--max_timeout', type=float, default=60.0, help='largest timeout a request may ask for')
+    parser.add_argument('--max_samples', type=int, default=16, help='largest num_samples a request may ask for')
+    parser.add_argument('--max_body_mb', type=float, default=16, help='largest accepted request body')
+    parser.add_argument('--cache_size', type=int, default=10000, help='palette cache entries, 0 disables it')
+    parser.add_argument('--tile_size', type=int, default=None, help='colorize larger images in tiles of this size')
+    parser.add_argument('--memory_budget_mb', type=int, default=None,
+                        help='derive the tile size from this activation memory budget')
+    parser.add_argument('--int8', type=int, default=0,
+                        help='serve a dynamically quantized TPN (CPU only); pass an int8 --pcn_path from quantize.py for the PCN')
+    parser.add_argument('--optimize', type=int, default=0,
+                        help='fold the PCN BatchNorms into its convolutions (see pal2color/optimize.py)')
+    parser.add_argument('--cpu_mode', type=str, default='nchw', choices=CPU_MODES,
+                        help='PCN memory format on CPU; prepack also freezes it with pre-packed oneDNN weights')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='server processes sharing this machine; each takes its share of the cores')
+    parser.add_argument('--worker_id', type=int, default=None, help='pin this process to its share of the cores')
+    parser.add_argument('--gpu', type=int, default=0)
+    add_device_args(parser)
+    add_amp_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    # worker_threads sets both thread counts itself, and inter-op threads can only be set once
+    if (args.num_workers > 1 or args.worker_id is not None) and (args.num_threads or args.num_interop_threads):
+        parser.error('--num_workers/--worker_id choose the thread counts; drop --num_threads/--num_interop_threads')
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.num_workers > 1 or args.worker_id is not None:
+        worker_threads(args.num_workers, args.worker_id)
+    device = setup_device(args)
+    profiler = Profiler.from_args(args, device)
+    tpn = PaletteGenerator.from_checkpoint(args.tpn_dir, prepare_data(), device=device, amp=args.amp,
+                                           int8=args.int8, profiler=profiler)
+    cache = PaletteCache(tpn, args.cache_size) if args.cache_size > 0 else None
+
+    # one worker thread: batches run back to back on the device
+    executor = ThreadPoolExecutor(max_workers=1)
+    batchers = {'palette': MicroBatcher(palette_batch(cache or tpn), executor,
+                                        args.max_batch_size, args.max_wait_ms, args.max_queue)}
+    if args.pcn_path is not None:
+        memory_budget = args.memory_budget_mb * 2**20 if args.memory_budget_mb else None
+        pipeline = Text2Colors(tpn, load_generator(args.pcn_path, device=device, optimize=args.optimize), batch_size=args.max_batch_size,
+                               tile_size=args.tile_size, memory_budget=memory_budget, amp=args.amp,
+                               cpu_mode=args.cpu_mode, profiler=profiler)
+        batchers['colorize'] = MicroBatcher(colorize_batch(pipeline), executor,
+                                            args.max_batch_size, args.max_wait_ms, args.max_queue)
+
+    try:
+        server = Server(batchers, args.timeout, cache, profiler, args.max_samples, args.max_timeout,
+                        int(args.max_body_mb * 2**20))
+        asyncio.run(server.serve(args.host, args.port))
+    finally:
+        if profiler.export(args.profile_dir, 'serve'):
+            print('Saved the profile to %s' % args.profile_dir)
+
+
+if __name__ == '__main__':
+    main()
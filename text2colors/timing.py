@@ -0,0 +1,16 @@
+import time
+import torch
+
+
+def timeit(fn, device, repeat=20, warmup=3):
+    # mean seconds per call of fn, waiting for queued CUDA work before reading the clock
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
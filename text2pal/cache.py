@@ -0,0 +1,174 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+def model_fingerprint(*modules, settings=()):
+    # hash of the weights and of the settings that change the outputs (the autocast
+    # dtype, say), so a retrained, replaced or reconfigured model does not read old entries
+    h = hashlib.sha1()
+
+    def update(value):
+        if torch.is_tensor(value):
+            if value.is_quantized:
+                value = value.int_repr()
+            h.update(str(value.dtype).encode('utf-8'))
+            h.update(value.detach().cpu().flatten().contiguous().view(torch.uint8).numpy().tobytes())
+        elif isinstance(value, (tuple, list)):
+            # dynamically quantized layers keep (weight, bias) packed in a tuple
+            for item in value:
+                update(item)
+        else:
+            h.update(repr(value).encode('utf-8'))
+
+    for module in modules:
+        for name, value in sorted(module.state_dict().items()):
+            h.update(name.encode('utf-8'))
+            update(value)
+    update(tuple(settings))
+    return h.hexdigest()
+
+
+class PaletteCache(object):
+    """Memoizes PaletteGenerator results for repeated prompts.
+
+    Entries are keyed on the token-id sequence (so "Ocean  Sunset" and
+    "ocean sunset" share an entry), the sample count and the seed. The memory
+    tier is an LRU bounded by ``max_entries`` with an optional ``ttl`` in
+    seconds; ``cache_dir`` adds a disk tier that survives restarts, in a
+    subdirectory named after a fingerprint of the TPN weights and its autocast
+    dtype. Unreadable disk entries count as misses and are removed. Unseeded
+    requests are random by design and always go to the model.
+    """
+    def __init__(self, generator, max_entries=10000, ttl=None, cache_dir=None):
+        self.generator = generator
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.cache_dir = None
+        if cache_dir is not None:
+            fingerprint = model_fingerprint(generator.encoder, generator.decoder,
+                                            settings=(str(generator.precision.dtype),))
+            self.cache_dir = os.path.join(cache_dir, fingerprint[:16])
+            if not os.path.isdir(self.cache_dir): os.makedirs(self.cache_dir)
+
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'bypassed': 0,
+                      'evictions': 0, 'expired': 0}
+
+    def generate(self, texts, num_samples=1, seed=None):
+        if seed is None:
+            with self.lock:
+                self.stats['bypassed'] += len(texts)
+            return self.generator.generate(texts, num_samples)
+
+        token_ids = self.generator.token_ids(texts)
+        keys = [(tuple(ids), num_samples, seed) for ids in token_ids]
+
+        entries = {}
+        for key in keys:
+            if key not in entries:
+                entries[key] = self.get(key)
+
+        missing = [key for key, entry in entries.items() if entry is None]
+        if missing:
+            words_index, lengths = self.generator.pad([list(key[0]) for key in missing])
+            result = self.generator.generate_tokens(words_index, lengths, num_samples, seed)
+            for i, key in enumerate(missing):
+                # clones, so an entry does not keep (or save) the storage of the whole batch
+                entries[key] = {'lab': result['lab'][i].clone(), 'rgb': result['rgb'][i].clone(),
+                                'hex': result['hex'][i]}
+                self.put(key, entries[key])
+
+        return {'lab': torch.stack([entries[key]['lab'] for key in keys]),
+                'rgb': torch.stack([entries[key]['rgb'] for key in keys]),
+                'hex': [entries[key]['hex'] for key in keys]}
+
+    def token_ids(self, texts):
+        return self.generator.token_ids(texts)
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                created, entry = self.memory[key]
+                if self.ttl is None or now - created < self.ttl:
+                    self.memory.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry
+                del self.memory[key]
+                self.stats['expired'] += 1
+
+        entry = self._disk_get(key, now)
+        with self.lock:
+            if entry is not None:
+                self.stats['disk_hits'] += 1
+                self._memory_put(key, entry, now)
+            else:
+                self.stats['misses'] += 1
+        return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self._memory_put(key, entry, time.time())
+        self._disk_put(key, entry)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def info(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self.memory)
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def _memory_put(self, key, entry, created):
+        self.memory[key] = (created, entry)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def _disk_path(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name + '.pt')
+
+    def _disk_get(self, key, now):
+        if self.cache_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            if self.ttl is not None and now - os.path.getmtime(path) >= self.ttl:
+                return None
+        except OSError:
+            return None
+        try:
+            entry = torch.load(path, weights_only=True)
+            if entry.get('key') == key:
+                return entry
+        except OSError:
+            return None
+        except (pickle.UnpicklingError, EOFError, ValueError, RuntimeError, AttributeError):
+            # a truncated or corrupt entry; drop it so the next put rewrites it
+            pass
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+    def _disk_put(self, key, entry):
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        torch.save(dict(entry, key=key), tmp_path)
+        os.replace(tmp_path, path)
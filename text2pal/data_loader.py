@@ -1,65 +1,152 @@
 import torch.utils.data as data
 import torch
-import pickle, os
+import pickle, os, hashlib
 import numpy as np
 from skimage.color import rgb2lab
 import warnings
 
 
+# bump whenever the cached tensors are computed differently
+CACHE_VERSION = 1
+
+
+def palettes_rgb2lab(palettes):
+    # (N, 5, 3) 0-255 RGB -> (N, 15) Lab, converted as a single image
+    rgb = np.asarray(palettes, dtype=np.float64).reshape(-1, 1, 3) / 255.0
+    warnings.filterwarnings("ignore")
+    lab = rgb2lab(rgb, illuminant='D50')
+    return lab.reshape(len(palettes), -1)
+
+
+def dataset_cache_key(src_path, trg_path, input_dict):
+    vocab = '\n'.join(input_dict.index2word[i] for i in range(input_dict.n_words))
+    key = {'version': CACHE_VERSION,
+           'max_len': input_dict.max_len,
+           'vocab': hashlib.sha1(vocab.encode('utf-8')).hexdigest()}
+    for name, path in (('src', src_path), ('trg', trg_path)):
+        stat = os.stat(path)
+        key[name] = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    return key
+
+
 class Dataset(data.Dataset):
-    def __init__(self, src_path, trg_path, input_dict):
+    def __init__(self, src_path, trg_path, input_dict, cache_file=None):
+        key = dataset_cache_key(src_path, trg_path, input_dict)
+
+        cache = None
+        if cache_file is not None and os.path.isfile(cache_file):
+            cache = torch.load(cache_file)
+            if cache.get('key') != key:
+                cache = None
+
+        if cache is None:
+            cache = self.build(src_path, trg_path, input_dict)
+            cache['key'] = key
+            if cache_file is not None:
+                cache_dir = os.path.dirname(cache_file)
+                if cache_dir and not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+                torch.save(cache, cache_file + '.tmp')
+                os.replace(cache_file + '.tmp', cache_file)
+
+        self.src_seqs = cache['src_seqs']
+        self.src_lens = cache['src_lens']
+        self.trg_seqs = cache['trg_seqs']
+        self.num_total_seqs = len(self.src_seqs)
+
+    def build(self, src_path, trg_path, input_dict):
         with open(src_path, 'rb') as fin:
-            self.src_seqs = pickle.load(fin)
+            src_names = pickle.load(fin)
         with open(trg_path, 'rb') as fin:
-            self.trg_seqs = pickle.load(fin)
-
-        words_index = []
-        for index, palette_name in enumerate(self.src_seqs):
-            temp = [0] * input_dict.max_len
-
-            for i, word in enumerate(palette_name):
-                temp[i] = input_dict.word2index[word]
-            words_index.append(temp)
-        self.src_seqs = torch.LongTensor(words_index)
-
-        palette_list = []
-        for index, palettes in enumerate(self.trg_seqs):
-            temp = []
-            for palette in palettes:
-                rgb = np.array([palette[0], palette[1], palette[2]]) / 255.0
-                warnings.filterwarnings("ignore")
-                lab = rgb2lab(rgb[np.newaxis, np.newaxis, :], illuminant='D50').flatten()
-                temp.append(lab[0])
-                temp.append(lab[1])
-                temp.append(lab[2])
-            palette_list.append(temp)
-
-        self.trg_seqs = torch.FloatTensor(palette_list)
-        self.num_total_seqs = len(self.src_seqs)
+            trg_palettes = pickle.load(fin)
+
+        words_index = np.zeros((len(src_names), input_dict.max_len), dtype=np.int64)
+        for index, palette_name in enumerate(src_names):
+            words_index[index, :len(palette_name)] = [input_dict.word2index[word] for word in palette_name]
+
+        return {'src_seqs': torch.from_numpy(words_index),
+                'src_lens': torch.LongTensor([len(palette_name) for palette_name in src_names]),
+                'trg_seqs': torch.from_numpy(palettes_rgb2lab(trg_palettes)).float()}
 
     def __getitem__(self, index):
         src_seq = self.src_seqs[index]
         trg_seq = self.trg_seqs[index]
-        return src_seq, trg_seq
+        src_len = self.src_lens[index]
+        return src_seq, trg_seq, src_len
 
     def __len__(self):
         return self.num_total_seqs
 
 
-def get_loader(batch_size, input_dict):
+class BucketBatchSampler(data.Sampler):
+    """Yields batches of indices whose sequences have (nearly) the same length.
+
+    Samples are shuffled, stably sorted by length and cut into batches, and the
+    batch order is shuffled again, so each batch only pads up to its own longest
+    name instead of ``Dictionary.max_len``. With ``drop_last`` the samples left
+    over are picked at random before sorting, so the longest names are not
+    always the ones dropped.
+    """
+    def __init__(self, lengths, batch_size, drop_last=True, shuffle=True):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            perm = torch.randperm(len(self.lengths))
+        else:
+            perm = torch.arange(len(self.lengths))
+        if self.drop_last:
+            perm = perm[:len(perm) - len(perm) % self.batch_size]
+        _, order = torch.sort(self.lengths[perm], stable=True)
+        batches = list(torch.split(perm[order], self.batch_size))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def get_loader(batch_size, input_dict, bucket_by_length=True, cache_dir='./data/hexcolor_vf/cache'):
     train_src_path = os.path.join('./data/hexcolor_vf/train_names.pkl')
     train_trg_path = os.path.join('./data/hexcolor_vf/train_palettes_rgb.pkl')
     val_src_path = os.path.join('./data/hexcolor_vf/test_names.pkl')
     val_trg_path = os.path.join('./data/hexcolor_vf/test_palettes_rgb.pkl')
 
-    train_dataset = Dataset(train_src_path, train_trg_path, input_dict)
+    train_cache = val_cache = None
+    if cache_dir is not None:
+        train_cache = os.path.join(cache_dir, 'train.pt')
+        val_cache = os.path.join(cache_dir, 'test.pt')
+
+    train_dataset = Dataset(train_src_path, train_trg_path, input_dict, train_cache)
+    val_dataset = Dataset(val_src_path, val_trg_path, input_dict, val_cache)
+
+    if bucket_by_length:
+        train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
+                                                   batch_sampler=BucketBatchSampler(
+                                                       train_dataset.src_lens, batch_size,
+                                                       drop_last=True, shuffle=True),
+                                                   num_workers=2)
+        val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
+                                                 batch_sampler=BucketBatchSampler(
+                                                     val_dataset.src_lens, batch_size,
+                                                     drop_last=True, shuffle=False),
+                                                 num_workers=2)
+        return train_loader, val_loader
+
     train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                batch_size=batch_size,
                                                num_workers=2,
                                                drop_last=True,
                                                shuffle=True)
 
-    val_dataset = Dataset(val_src_path, val_trg_path, input_dict)
     val_loader = torch.utils.data.DataLoader(dataset=val_dataset,
                                              batch_size=batch_size,
                                              num_workers=2,
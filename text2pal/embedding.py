@@ -43,27 +43,152 @@ def prepare_data():
     return input_dict
 
 
-def load_pretrained_embedding(dictionary, embed_file, embed_dim):
-    if embed_file is None: return None
-
-    pretrained_embed = {}
-    with open(embed_file, 'r', encoding='utf-8') as f:
+def stream_glove(embed_file, words, embed_dim):
+    # only decode and parse the rows we are looking for; the vector is the last
+    # embed_dim fields, since some GloVe keys contain spaces themselves
+    wanted = {word.encode('utf-8'): word for word in words if word != '<unk>'}
+    spaced_keys = any(b' ' in key for key in wanted)
+    found = {}
+    with open(embed_file, 'rb') as f:
         for line in f:
-            tokens = line.split(' ')
-            word = tokens[0]
-            entries = tokens[1:]
-            if word == '<unk>':
+            if spaced_keys:
+                key = line.rstrip().rsplit(b' ', embed_dim)[0]
+            else:
+                key = line[:line.find(b' ')]
+            if key not in wanted:
                 continue
-            pretrained_embed[word] = entries
-        f.close()
+            fields = line.rstrip().rsplit(b' ', embed_dim)
+            if len(fields) != embed_dim + 1 or fields[0] != key:
+                continue
+            try:
+                vector = np.array(fields[1:], dtype=np.float32)
+            except ValueError:
+                continue
+            found[wanted.pop(key)] = vector
+            if not wanted:
+                break
+    return found
+
+
+def load_pretrained_embedding(dictionary, embed_file, embed_dim):
+    if embed_file is None: return None
 
     vocab_size = len(dictionary) + 2
     W_emb = np.random.randn(vocab_size, embed_dim).astype('float32')
-    n = 0
-    for word, index in dictionary.items():
-        if word in pretrained_embed:
-            W_emb[index, :] = pretrained_embed[word]
-            n += 1
+    found = stream_glove(embed_file, dictionary.keys(), embed_dim)
+    for word, vector in found.items():
+        W_emb[dictionary[word], :] = vector
+
+    print ("%d/%d vocabs are initialized with GloVe embeddings." % (len(found), vocab_size))
+    return W_emb
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return '%s %d %d' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+class EmbeddingCache:
+    """On-disk cache of the GloVe rows for every word we have ever looked up.
+
+    ``vectors.npy`` holds the float32 rows (memory-mapped on load) in the order of
+    ``words.txt``; ``missing.txt`` lists words GloVe does not have, so that a
+    growing vocabulary only streams the embedding file for the new words.
+    ``source.txt`` records the path, size and mtime of ``embed_file``; the
+    cache is rebuilt when they change.
+    """
+    def __init__(self, cache_dir, embed_dim, embed_file):
+        self.cache_dir = cache_dir
+        self.embed_dim = embed_dim
+        self.words_file = os.path.join(cache_dir, 'words.txt')
+        self.vectors_file = os.path.join(cache_dir, 'vectors.npy')
+        self.missing_file = os.path.join(cache_dir, 'missing.txt')
+        self.source_file = os.path.join(cache_dir, 'source.txt')
 
+        self.words = self._read_lines(self.words_file)
+        self.missing = set(self._read_lines(self.missing_file))
+        if os.path.isfile(self.vectors_file):
+            self.vectors = np.load(self.vectors_file, mmap_mode='r')
+        else:
+            self.vectors = np.zeros((0, embed_dim), dtype=np.float32)
+
+        source = file_fingerprint(embed_file)
+        if self._read_lines(self.source_file) != [source]:
+            if self.words or self.missing:
+                print("%s has changed, rebuilding the embedding cache in %s..." % (embed_file, cache_dir))
+            self.clear()
+            self._write_lines(self.source_file, [source])
+        elif self.vectors.shape != (len(self.words), embed_dim):
+            print("Embedding cache in %s is inconsistent, rebuilding it..." % cache_dir)
+            self.clear()
+        self.word2row = {word: row for row, word in enumerate(self.words)}
+
+    def clear(self):
+        self.words, self.missing = [], set()
+        self.vectors = np.zeros((0, self.embed_dim), dtype=np.float32)
+        for path in (self.words_file, self.vectors_file, self.missing_file):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def known(self):
+        return set(self.word2row) | self.missing
+
+    def update(self, found, missing):
+        new_words = [word for word in found if word not in self.word2row]
+        if new_words:
+            new_vectors = np.stack([found[word] for word in new_words]).astype(np.float32)
+            vectors = np.concatenate((np.asarray(self.vectors), new_vectors), axis=0)
+            self._atomic_save(self.vectors_file, lambda f: np.save(f, vectors))
+            self._write_lines(self.words_file, self.words + new_words)
+            self.words = self.words + new_words
+            self.vectors = np.load(self.vectors_file, mmap_mode='r')
+            self.word2row = {word: row for row, word in enumerate(self.words)}
+
+        missing = set(missing) - self.missing
+        if missing:
+            self.missing |= missing
+            self._write_lines(self.missing_file, sorted(self.missing))
+
+    def lookup(self, dictionary, vocab_size):
+        W_emb = np.random.randn(vocab_size, self.embed_dim).astype('float32')
+        rows, indices = [], []
+        for word, index in dictionary.items():
+            if word in self.word2row:
+                rows.append(self.word2row[word])
+                indices.append(index)
+        if rows:
+            W_emb[indices] = self.vectors[np.array(rows)]
+        return W_emb, len(rows)
+
+    def _read_lines(self, path):
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read().split('\n')[:-1]
+
+    def _write_lines(self, path, lines):
+        def write(f):
+            f.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+        self._atomic_save(path, write)
+
+    def _atomic_save(self, path, write):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+
+def load_cached_embedding(dictionary, embed_file, embed_dim, cache_dir):
+    if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+    cache = EmbeddingCache(cache_dir, embed_dim, embed_file)
+
+    new_words = set(dictionary) - cache.known()
+    if new_words:
+        print("Looking up %d new words in %s..." % (len(new_words), embed_file))
+        found = stream_glove(embed_file, new_words, embed_dim)
+        cache.update(found, new_words - set(found))
+
+    vocab_size = len(dictionary) + 2
+    W_emb, n = cache.lookup(dictionary, vocab_size)
     print ("%d/%d vocabs are initialized with GloVe embeddings." % (n, vocab_size))
     return W_emb
\ No newline at end of file
@@ -0,0 +1,157 @@
+#! /usr/bin/env python
+import os
+import argparse
+import torch
+import torch.nn as nn
+
+from text2pal.model import *
+from text2pal.embedding import prepare_data
+from text2pal.inference import PaletteGenerator
+
+
+def split_gru(gru):
+    # one single-layer GRU per layer, sharing the weights of a unidirectional multi-layer GRU
+    layers = []
+    for l in range(gru.num_layers):
+        layer = nn.GRU(gru.input_size if l == 0 else gru.hidden_size, gru.hidden_size, 1, bias=gru.bias)
+        for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'):
+            if hasattr(gru, '%s_l%d' % (name, l)):
+                setattr(layer, '%s_l0' % name, getattr(gru, '%s_l%d' % (name, l)))
+        layers.append(layer)
+    return layers
+
+
+class PaletteNet(nn.Module):
+    """Traceable TPN inference: (token ids, lengths, CA noise) -> (batch, 5, 3) Lab.
+
+    Computes what PaletteGenerator does for one sample per prompt, without
+    packed sequences: each GRU layer runs over the padded batch and its final
+    hidden state is gathered at the last real word, and the five decoder steps
+    are unrolled. ``eps`` is (max_len, batch, 150); zeros give the mean palette.
+    """
+    def __init__(self, encoder, decoder):
+        super(PaletteNet, self).__init__()
+        self.embed = encoder.embed
+        self.ca_net = encoder.ca_net
+        self.layers = nn.ModuleList(split_gru(encoder.gru))
+        self.decoder = decoder
+        self.eval()
+
+    def forward(self, words_index, lengths, eps):
+        padding_mask = length_mask(lengths, words_index.size(1))
+        last = (lengths - 1).view(1, -1, 1)
+
+        output = self.embed(words_index).transpose(0, 1)
+        hidden = []
+        for gru in self.layers:
+            output, _ = gru(output)
+            hidden.append(output.gather(0, last.expand(1, output.size(1), output.size(2))))
+        # packed sequences return zeros past each prompt's end
+        output = output.masked_fill(padding_mask.unsqueeze(2), 0)
+
+        encoder_outputs, _, _ = self.ca_net(output, eps)
+        palettes = decode_palette(self.decoder, encoder_outputs, torch.cat(hidden, 0), padding_mask)
+        return palettes.view(-1, 5, 3)
+
+
+def sample_inputs(n_words, max_len, batch_size, c_dim=150, seed=0):
+    # random prompts of mixed lengths up to max_len, with seeded CA noise; the
+    # longest and the shortest length are always there so padding is exercised
+    g = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(1, max_len + 1, (batch_size,), generator=g)
+    lengths[0] = max_len
+    if batch_size > 1:
+        lengths[-1] = 1
+    # ids 0 and 1 are SOS and EOS, not words
+    words_index = torch.randint(2, n_words, (batch_size, max_len), generator=g)
+    words_index[torch.arange(max_len).unsqueeze(0) >= lengths.unsqueeze(1)] = 0
+    eps = torch.randn(max_len, batch_size, c_dim, generator=g)
+    return words_index, lengths, eps
+
+
+def export_torchscript(net, inputs, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(net, inputs)
+    traced.save(path)
+    return torch.jit.load(path)
+
+
+def export_onnx(net, inputs, path, opset_version=17):
+    with torch.no_grad():
+        torch.onnx.export(net, inputs, path, opset_version=opset_version,
+                          input_names=['words_index', 'lengths', 'eps'], output_names=['palettes'],
+                          dynamic_axes={'words_index': {0: 'batch', 1: 'max_len'},
+                                        'lengths': {0: 'batch'},
+                                        'eps': {0: 'max_len', 1: 'batch'},
+                                        'palettes': {0: 'batch'}})
+
+
+def run_onnx(path, inputs):
+    # onnxruntime is optional; returns None when it is not installed
+    try:
+        import onnxruntime
+    except ImportError:
+        return None
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    feeds = {name: tensor.numpy() for name, tensor in zip(['words_index', 'lengths', 'eps'], inputs)}
+    return torch.from_numpy(session.run(None, feeds)[0])
+
+
+def check_parity(generator, runtimes, inputs, atol=1e-4):
+    # every runtime against the eager PaletteGenerator; returns {name: max abs diff}
+    words_index, lengths, eps = inputs
+    with torch.no_grad():
+        reference = generator._forward(words_index, lengths, 1, eps).view(-1, 5, 3).cpu()
+    diffs = {}
+    for name, run in runtimes.items():
+        out = run(inputs)
+        if out is None:
+            print('%-12s skipped (onnxruntime is not installed)' % name)
+            continue
+        diffs[name] = (out.cpu() - reference).abs().max().item()
+        print('%-12s max |diff| vs eager: %.2e' % (name, diffs[name]))
+        assert diffs[name] < atol, '%s does not match eager TPN inference' % name
+    return diffs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export the TPN to TorchScript and ONNX')
+    parser.add_argument('--tpn_dir', type=str, required=True, help='directory with encoder.pkl and decoder.pkl')
+    parser.add_argument('--out_dir', type=str, default=None, help='defaults to --tpn_dir')
+    parser.add_argument('--hidden_size', type=int, default=150)
+    parser.add_argument('--n_layers', type=int, default=4)
+    parser.add_argument('--opset_version', type=int, default=17)
+    parser.add_argument('--parity_batch_size', type=int, default=33)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    out_dir = args.out_dir or args.tpn_dir
+    input_dict = prepare_data()
+    generator = PaletteGenerator.from_checkpoint(args.tpn_dir, input_dict, args.hidden_size, args.n_layers)
+    net = PaletteNet(generator.encoder, generator.decoder)
+
+    # trace with a small batch, then check parity on other batch sizes and prompt lengths
+    max_len = input_dict.max_len
+    example = sample_inputs(input_dict.n_words, max_len, 2, seed=0)
+    parity_inputs = [sample_inputs(input_dict.n_words, max_len, args.parity_batch_size, seed=1),
+                     sample_inputs(input_dict.n_words, max(max_len // 2, 1), 5, seed=2)]
+
+    ts_path = os.path.join(out_dir, 'tpn.pt')
+    onnx_path = os.path.join(out_dir, 'tpn.onnx')
+    traced = export_torchscript(net, example, ts_path)
+    export_onnx(net, example, onnx_path, args.opset_version)
+    print('Saved %s and %s' % (ts_path, onnx_path))
+
+    runtimes = {'PaletteNet': lambda x: net(*x),
+                'TorchScript': lambda x: traced(*x),
+                'ONNX': lambda x: run_onnx(onnx_path, x)}
+    with torch.no_grad():
+        for inputs in parity_inputs:
+            print('batch %d, max_len %d' % tuple(inputs[0].shape))
+            check_parity(generator, runtimes, inputs)
+
+
+if __name__ == '__main__':
+    main()
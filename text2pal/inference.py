@@ -0,0 +1,115 @@
+import os
+import torch
+
+from text2pal.model import *
+from pal2color.lab import lab2rgb
+from text2colors.amp import Precision
+from text2colors.quantization import quantize_tpn
+from text2colors.profiling import Profiler
+
+
+def rgb2hex(rgb):
+    r, g, b = [int(round(c * 255)) for c in rgb]
+    return '#%02x%02x%02x' % (r, g, b)
+
+
+class PaletteGenerator(object):
+    """Batched text-to-palette inference for a trained TPN.
+
+    All prompts of a request are encoded in a single pass, and the five decoder
+    steps run once for all ``num_samples`` conditioning-augmentation draws of
+    every prompt.
+    """
+    def __init__(self, encoder, decoder, input_dict, device=None, amp='none', profiler=None):
+        self.encoder = encoder.eval()
+        self.decoder = decoder.eval()
+        self.input_dict = input_dict
+        self.device = device if device is not None else next(encoder.parameters()).device
+        self.precision = Precision(amp, self.device)
+        self.profiler = profiler if profiler is not None else Profiler(False, self.device)
+
+    @classmethod
+    def from_checkpoint(cls, model_dir, input_dict, hidden_size=150, n_layers=4,
+                        dropout_p=0.2, device='cpu', amp='none', int8=False, profiler=None):
+        device = torch.device(device)
+        encoder = EncoderRNN(input_dict.n_words, hidden_size, n_layers, dropout_p)
+        decoder = AttnDecoderRNN(hidden_size, input_dict, n_layers, dropout_p)
+        encoder.load_state_dict(torch.load(os.path.join(model_dir, 'encoder.pkl'), map_location='cpu', weights_only=True))
+        decoder.load_state_dict(torch.load(os.path.join(model_dir, 'decoder.pkl'), map_location='cpu', weights_only=True))
+        if int8:
+            # dynamic quantization needs no calibration data, so it is applied at load time
+            if device.type != 'cpu':
+                raise ValueError('int8 models run on CPU only')
+            encoder, decoder = quantize_tpn(encoder, decoder)
+        return cls(encoder.to(device), decoder.to(device), input_dict, device, amp, profiler)
+
+    def token_ids(self, texts):
+        # words missing from the dictionary are dropped
+        token_ids = []
+        for text in texts:
+            words = text.lower().split() if isinstance(text, str) else text
+            ids = [self.input_dict.word2index[word] for word in words
+                   if word in self.input_dict.word2index]
+            if not ids:
+                raise ValueError("No known words in prompt: %r" % (text,))
+            token_ids.append(ids)
+        return token_ids
+
+    def tokenize(self, texts):
+        return self.pad(self.token_ids(texts))
+
+    def pad(self, token_ids):
+        lengths = torch.LongTensor([len(ids) for ids in token_ids])
+        words_index = torch.zeros(len(token_ids), int(lengths.max()), dtype=torch.long)
+        for i, ids in enumerate(token_ids):
+            words_index[i, :len(ids)] = torch.LongTensor(ids)
+        return words_index, lengths
+
+    def generate(self, texts, num_samples=1, seed=None):
+        words_index, lengths = self.tokenize(texts)
+        return self.generate_tokens(words_index, lengths, num_samples, seed)
+
+    def generate_tokens(self, words_index, lengths, num_samples=1, seed=None):
+        lab = self.generate_lab(words_index, lengths, num_samples, seed).cpu()
+        rgb = lab2rgb(lab.double(), dim=-1).float()
+        hex_codes = [[[rgb2hex(color) for color in sample] for sample in prompt] for prompt in rgb.tolist()]
+        return {'lab': lab, 'rgb': rgb, 'hex': hex_codes}
+
+    def generate_lab(self, words_index, lengths, num_samples=1, seed=None):
+        # (batch, num_samples, 5, 3) Lab palettes, left on self.device
+        eps = None
+        if seed is not None:
+            eps = self.seeded_noise(lengths, num_samples, seed, words_index.size(1))
+
+        with torch.no_grad(), self.precision.autocast():
+            lab = self._forward(words_index, lengths, num_samples, eps)
+        return lab.float().view(words_index.size(0), num_samples, 5, 3)
+
+    def seeded_noise(self, lengths, num_samples, seed, max_len):
+        # drawn per prompt, so a seeded prompt gives the same palettes in any batch
+        c_dim = self.encoder.ca_net.c_dim
+        eps = torch.zeros(max_len, len(lengths) * num_samples, c_dim)
+        g = torch.Generator()
+        for i, length in enumerate(lengths.tolist()):
+            g.manual_seed(seed)
+            noise = torch.randn(num_samples, length, c_dim, generator=g)
+            eps[:length, i * num_samples:(i + 1) * num_samples] = noise.transpose(0, 1)
+        return eps.to(self.device)
+
+    def _forward(self, words_index, lengths, num_samples, eps=None):
+        batch_size = words_index.size(0)
+        words_index = words_index.to(self.device)
+
+        # the GRU runs once per prompt; only the CA noise differs between samples
+        with self.profiler.stage('tpn/encoder'):
+            encoder_hidden = self.encoder.init_hidden(batch_size)
+            output, decoder_hidden = self.encoder.encode(words_index, encoder_hidden, lengths)
+
+        output = output.repeat_interleave(num_samples, dim=1)
+        decoder_hidden = decoder_hidden.repeat_interleave(num_samples, dim=1)
+        lengths = lengths.repeat_interleave(num_samples)
+
+        with self.profiler.stage('tpn/decoder'):
+            encoder_outputs, _, _ = self.encoder.ca_net(output, eps)
+            padding_mask = length_mask(lengths, encoder_outputs.size(0), self.device)
+            return decode_palette(self.decoder, encoder_outputs, decoder_hidden, padding_mask)
@@ -1,9 +1,10 @@
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from random import *
 from text2pal.utils import *
+from text2pal.embedding import SOS_token
 
 
 class CA_NET(nn.Module):
@@ -21,15 +22,15 @@ class CA_NET(nn.Module):
         logvar = x[:, :, self.c_dim:]
         return mu, logvar
 
-    def reparametrize(self, mu, logvar):
+    def reparametrize(self, mu, logvar, eps=None):
         std = logvar.mul(0.5).exp_()
-        eps = torch.cuda.FloatTensor(std.size()).normal_(0.0, 1)
-        eps = Variable(eps)
+        if eps is None:
+            eps = torch.randn_like(std)
         return eps * std + mu
 
-    def forward(self, text_embedding):
+    def forward(self, text_embedding, eps=None):
         mu, logvar = self.encode(text_embedding)
-        c_code = self.reparametrize(mu, logvar)
+        c_code = self.reparametrize(mu, logvar, eps)
         return c_code, mu, logvar
 
 
@@ -44,15 +45,27 @@ class EncoderRNN(nn.Module):
         self.ca_net = CA_NET()
         self.gru = nn.GRU(300, hidden_size, n_layers, dropout=dropout_p)
 
-    def forward(self, word_inputs, hidden):
-        embedded = self.embed(word_inputs).transpose(0,1)
-        output, hidden = self.gru(embedded, hidden)
+    def forward(self, word_inputs, hidden, lengths=None):
+        output, hidden = self.encode(word_inputs, hidden, lengths)
         c_code, mu, logvar = self.ca_net(output)
 
         return c_code, hidden, mu, logvar
 
+    def encode(self, word_inputs, hidden, lengths=None):
+        embedded = self.embed(word_inputs).transpose(0,1)
+        if lengths is None:
+            output, hidden = self.gru(embedded, hidden)
+        else:
+            # skip the GRU steps over padding; padded outputs come back as zeros
+            packed = pack_padded_sequence(embedded, torch.as_tensor(lengths).cpu(),
+                                          enforce_sorted=False)
+            output, hidden = self.gru(packed, hidden)
+            output, _ = pad_packed_sequence(output, total_length=embedded.size(0))
+        return output, hidden
+
     def init_hidden(self,batch_size):
-        hidden = Variable(torch.zeros(self.n_layers, batch_size, self.hidden_size)).cuda()
+        weight = next(self.parameters())
+        hidden = weight.new_zeros(self.n_layers, batch_size, self.hidden_size)
         return hidden
 
 
@@ -101,17 +114,16 @@ class Attn(nn.Module):
 
     def forward(self, hidden, encoder_outputs, each_size):
         seq_len = encoder_outputs.size(0)
-        batch_size = encoder_outputs.size(1)
-        attn_energies = Variable(torch.zeros(seq_len,batch_size,1)).cuda()
 
-        for i in range(seq_len):
-            attn_energies[i] = self.score(hidden, encoder_outputs[i])
+        # each_size is either the per-sample lengths or a precomputed padding mask
+        if torch.is_tensor(each_size) and each_size.dtype == torch.bool:
+            mask = each_size
+        else:
+            mask = length_mask(each_size, seq_len, encoder_outputs.device)
 
-        for i in range(batch_size):
-            try:
-                attn_energies[each_size[i]:,i] = -float('Inf')
-            except:
-                pass
+        # score every timestep at once: (seq_len, batch, 1)
+        attn_energies = self.score(hidden.unsqueeze(0), encoder_outputs)
+        attn_energies = attn_energies.masked_fill(mask.unsqueeze(2), -float('Inf'))
 
         attn_energies = self.softmax(attn_energies)
         return attn_energies.permute(1,2,0)
@@ -123,6 +135,29 @@ class Attn(nn.Module):
         return energy
 
 
+def decode_palette(decoder, encoder_outputs, decoder_hidden, each_size, num_colors=5):
+    # runs the attention decoder from SOS for every color; returns (batch, 3 * num_colors)
+    batch_size = encoder_outputs.size(1)
+    decoder_context = encoder_outputs.new_zeros(1, batch_size, decoder.hidden_size)
+    palette = encoder_outputs.new_full((1, batch_size, 3), SOS_token)
+
+    colors = []
+    for i in range(num_colors):
+        palette, decoder_context, decoder_hidden, _ = decoder(palette, decoder_context,
+                                                              decoder_hidden, encoder_outputs,
+                                                              each_size)
+        colors.append(palette)
+        palette = palette.unsqueeze(0)
+    return torch.cat(colors, 1)
+
+
+def length_mask(lengths, max_len, device=None):
+    # True at padded positions, shape (max_len, batch)
+    lengths = torch.as_tensor(lengths, device=device)
+    steps = torch.arange(max_len, device=lengths.device).unsqueeze(1)
+    return steps >= lengths.unsqueeze(0)
+
+
 class Discriminator(nn.Module):
     def __init__(self, color_size=15, hidden_dim=150):
         super(Discriminator, self).__init__()
@@ -135,8 +170,8 @@ class Discriminator(nn.Module):
         layers.append(nn.ReLU(inplace=True))
         layers.append(nn.Linear(int(curr_dim/4), int(curr_dim/8)))
         layers.append(nn.ReLU(inplace=True))
-        layers.append(nn.Linear(int(curr_dim/8), 1)) # 9 -> 1
-        layers.append(nn.Sigmoid())
+        # 9 -> 1 logits; train with BCEWithLogitsLoss, which stays finite under autocast
+        layers.append(nn.Linear(int(curr_dim/8), 1))
 
         self.main = nn.Sequential(*layers)
 
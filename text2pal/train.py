@@ -1,16 +1,18 @@
 import os, sys
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 
 from text2pal.model import *
+from text2pal.embedding import SOS_token
 from text2pal.utils import *
-
-SOS_token = 0
+from text2colors.amp import Precision
+from text2colors.checkpoint import CheckpointManager
+from text2colors.profiling import Profiler
 
 class TrainGAN(object):
-    def __init__(self, train_loader, val_loader, encoder, decoder, discriminator, args):
+    def __init__(self, train_loader, val_loader, encoder, decoder, discriminator, args, device=None):
         self.args = args
+        self.device = device if device is not None else next(encoder.parameters()).device
         self.train_loader = train_loader
         self.val_loader = val_loader
 
@@ -23,97 +25,154 @@ class TrainGAN(object):
         self.D = discriminator
         self.D.apply(init_weights_normal)
 
-        self.criterion_GAN = nn.BCELoss()
+        self.criterion_GAN = nn.BCEWithLogitsLoss()
         self.criterion_smoothL1 = nn.SmoothL1Loss()
         self.optimizer_G = torch.optim.Adam(self.G_parameters,
                                             lr=args.lr, weight_decay=args.weight_decay)
         self.optimizer_D = torch.optim.Adam(self.D.parameters(),
                                             lr=args.lr, betas=(args.beta1, args.beta2))
+        self.precision = Precision(getattr(args, 'amp', 'none'), self.device)
+
+        self.save_dir = os.path.join(args.save_dir, args.loss_combination,
+                                     'sL1'+str(args.lambda_sL1)+'_KL'+str(args.lambda_KL))
+        self.checkpoints = CheckpointManager(os.path.join(self.save_dir, 'ckpt'), 'tpn',
+                                             getattr(args, 'keep_ckpts', 3))
+        self.start_epoch = 1
+        self.global_step = 0
+        self.profiler = Profiler.from_args(args, self.device)
+
+    def state_dict(self, epoch):
+        return {'epoch': epoch,
+                'step': self.global_step,
+                'args': vars(self.args),
+                'encoder': self.encoder.state_dict(),
+                'decoder': self.decoder.state_dict(),
+                'D': self.D.state_dict(),
+                'optimizer_G': self.optimizer_G.state_dict(),
+                'optimizer_D': self.optimizer_D.state_dict(),
+                'precision': self.precision.state_dict()}
+
+    def resume(self):
+        checkpoint = self.checkpoints.load_latest(self.device)
+        if checkpoint is None:
+            print("Sorry, no checkpoint found.")
+            return
+        self.encoder.load_state_dict(checkpoint['encoder'])
+        self.decoder.load_state_dict(checkpoint['decoder'])
+        self.D.load_state_dict(checkpoint['D'])
+        self.optimizer_G.load_state_dict(checkpoint['optimizer_G'])
+        self.optimizer_D.load_state_dict(checkpoint['optimizer_D'])
+        self.precision.load_state_dict(checkpoint['precision'])
+        self.start_epoch = checkpoint['epoch']
+        self.global_step = checkpoint['step']
+        print("Start training from epoch {}, step {}.".format(self.start_epoch, self.global_step))
 
     def train(self):
         self.encoder.train()
         self.decoder.train()
         self.D.train()
-        
-        for epoch in range(1, self.args.epochs + 1):
-            steps = 0
-
-            for i, data in enumerate(self.train_loader):
 
-                txt_embeddings, real_palettes = data
-                batch_size = txt_embeddings.size(0)
+        completed = False
+        try:
+            self._train()
+            completed = True
+        finally:
+            if self.profiler.export(getattr(self.args, 'profile_dir', './profile'), 'text2pal'):
+                print('\nSaved the profile to %s' % self.args.profile_dir)
+            # let the last queued checkpoint reach the disk, without hiding a training error
+            self.checkpoints.close(raise_errors=completed)
+
+    def _train(self):
+        profiler = self.profiler
+        for epoch in range(self.start_epoch, self.args.epochs + 1):
+            steps = 0
 
-                indices = torch.nonzero(txt_embeddings)
-                temp = []
-                for index in indices:
-                    temp.append(index[0])
+            for i, data in enumerate(profiler.iterate(self.train_loader)):
 
-                each_input_size = [0]*batch_size
-                for j in range(batch_size):
-                    each_input_size[j] = temp.count(j)
+                txt_embeddings, real_palettes, each_input_size = data
 
-                txt_embeddings = Variable(txt_embeddings).cuda()
-                real_palettes = Variable(real_palettes).cuda()
+                # drop the columns that are padding for every sample in the batch
+                max_len = int(each_input_size.max())
+                txt_embeddings = txt_embeddings[:, :max_len].to(self.device)
+                padding_mask = length_mask(each_input_size, max_len, self.device)
+                real_palettes = real_palettes.to(self.device)
                 real_palettes = real_palettes.float()
 
                 batch_size = real_palettes.size(0)
-                real_labels = Variable(torch.ones(batch_size)).cuda()
-                fake_labels = Variable(torch.zeros(batch_size)).cuda()
-
-                decoder_context = Variable(torch.zeros(1, batch_size, self.decoder.hidden_size)).cuda()
-                palette = Variable(torch.FloatTensor([[SOS_token]])).unsqueeze(2).expand(1, batch_size, 3).cuda()
-                fake_palettes = Variable(torch.FloatTensor(batch_size, 15).zero_()).cuda()
+                real_labels = torch.ones(batch_size, device=self.device)
+                fake_labels = torch.zeros(batch_size, device=self.device)
 
                 encoder_hidden = self.encoder.init_hidden(batch_size)
-                encoder_outputs, decoder_hidden, mu, logvar = self.encoder(txt_embeddings, encoder_hidden)
+                each_input_size_ = each_input_size.float().unsqueeze(1).to(self.device)
 
-                for i in range(5):
-                    palette, decoder_context, decoder_hidden, _ = self.decoder(palette, decoder_context,
-                                                                               decoder_hidden, encoder_outputs,
-                                                                               each_input_size)
-                    fake_palettes[:, 3 * i:3 * (i + 1)] = palette
-                    palette = palette.unsqueeze(0)
+                with self.precision.autocast():
+                    with profiler.stage('encoder'):
+                        encoder_outputs, decoder_hidden, mu, logvar = self.encoder(txt_embeddings, encoder_hidden,
+                                                                                   each_input_size)
 
-                each_input_size_ = Variable(torch.FloatTensor(each_input_size).unsqueeze(1)
-                                            .expand(batch_size,self.decoder.hidden_size),
-                                            requires_grad=False).cuda()
+                    with profiler.stage('decoder'):
+                        fake_palettes = decode_palette(self.decoder, encoder_outputs, decoder_hidden, padding_mask)
 
-                encoder_outputs = torch.sum(encoder_outputs, 0)
-                encoder_outputs = torch.div(encoder_outputs, each_input_size_)
+                    with profiler.stage('d_forward'):
+                        # mean over the real words only
+                        encoder_outputs = encoder_outputs.masked_fill(padding_mask.unsqueeze(2), 0)
+                        encoder_outputs = torch.sum(encoder_outputs, 0)
+                        encoder_outputs = torch.div(encoder_outputs, each_input_size_)
 
-                real = self.D(real_palettes, encoder_outputs)
-                loss_D_real = self.criterion_GAN(real, real_labels)
+                        # D trains on detached inputs, so its step leaves the generator graph intact
+                        real = self.D(real_palettes, encoder_outputs.detach())
+                        fake = self.D(fake_palettes.detach(), encoder_outputs.detach())
 
-                fake = self.D(fake_palettes, encoder_outputs)
+                # losses in float32, outside autocast
+                real, fake = real.float(), fake.float()
+
+                loss_D_real = self.criterion_GAN(real, real_labels)
                 loss_D_fake = self.criterion_GAN(fake, fake_labels)
 
                 loss_D = loss_D_real + loss_D_fake
-                self.optimizer_D.zero_grad()
-                loss_D.backward(retain_graph=True)
-                self.optimizer_D.step()
+                with profiler.stage('d_backward'):
+                    self.optimizer_D.zero_grad()
+                    self.precision.backward(loss_D)
+                    self.precision.step(self.optimizer_D)
+
+                # the D step updated its weights in place, so the G loss needs a fresh forward
+                with profiler.stage('d_forward_fake'), self.precision.autocast():
+                    fake = self.D(fake_palettes, encoder_outputs)
+                fake, fake_palettes = fake.float(), fake_palettes.float()
+                mu, logvar = mu.float(), logvar.float()
 
                 loss_G_GAN = self.criterion_GAN(fake, real_labels)
                 loss_G_smoothL1 = self.criterion_smoothL1(fake_palettes, real_palettes) * self.args.lambda_sL1
                 
                 kl_loss = KL_loss(mu, logvar) * self.args.lambda_KL
                 loss_G = loss_G_GAN + loss_G_smoothL1 + kl_loss
-                self.optimizer_G.zero_grad()
-                loss_G.backward()
-                self.optimizer_G.step()
+                with profiler.stage('g_backward'):
+                    self.optimizer_G.zero_grad()
+                    self.precision.backward(loss_G)
+                    self.precision.step(self.optimizer_G)
+                    self.precision.update()
 
                 steps += 1
+                self.global_step += 1
                 if steps % self.args.log_interval == 0:
-                    sys.stdout.write(
-                        '\rEpoch [{}], Batch[{}] - d_loss: {:.6f}, g_loss: {:.6f}'.format(
-                            epoch, steps, loss_D.data[0], loss_G.data[0]))
+                    # .item() waits for the device, so it only happens on the steps that are logged
+                    with profiler.stage('log'):
+                        sys.stdout.write(
+                            '\rEpoch [{}], Batch[{}] - d_loss: {:.6f}, g_loss: {:.6f}'.format(
+                                epoch, steps, loss_D.item(), loss_G.item()))
+                if profiler.enabled and self.global_step % self.args.profile_interval == 0:
+                    print('\n' + profiler.report())
 
-            if epoch % 10 == 0:
-                save_dir = os.path.join(self.args.save_dir, self.args.loss_combination,
-                                        'sL1'+str(self.args.lambda_sL1)+'_KL'+str(self.args.lambda_KL))
-                if not os.path.isdir(save_dir): os.makedirs(save_dir)
+                # mid-epoch checkpoints resume at the start of the same epoch
+                if self.global_step % self.args.save_interval == 0:
+                    self.checkpoints.save(self.state_dict(epoch), self.global_step)
+
+            # replaces a mid-epoch checkpoint taken at the same step
+            self.checkpoints.save(self.state_dict(epoch + 1), self.global_step)
 
+            if epoch % 10 == 0:
                 torch.save(self.decoder.state_dict(),
-                           os.path.join(save_dir, 'decoder.pkl'))
+                           os.path.join(self.save_dir, 'decoder.pkl'))
                 torch.save(self.encoder.state_dict(),
-                           os.path.join(save_dir, 'encoder.pkl'))
+                           os.path.join(self.save_dir, 'encoder.pkl'))
 
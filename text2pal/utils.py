@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
-from torch.autograd import Variable
 
 class Embed(nn.Module):
     def __init__(self, vocab_size, embed_dim, W_emb, train_emb):
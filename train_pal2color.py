@@ -3,14 +3,17 @@ import os
 import torch
 import argparse
 import torch.nn as nn
-from torch import cuda
-from torch.autograd import Variable
 
 from pal2color.model import *
 from pal2color.util import *
 from pal2color.global_hint import *
 from pal2color.data_loader import *
 from pal2color.gan import *
+from text2colors.device import add_device_args, setup_device
+from text2colors.amp import add_amp_args, Precision
+from text2colors.checkpoint import CheckpointManager
+from text2colors.distributed import *
+from text2colors.profiling import Profiler, add_profile_args
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -24,19 +27,35 @@ def parse_args():
     parser.add_argument('--start_epoch', type=int, default=0)
     parser.add_argument('--batch_size', type=int, default=15)
     parser.add_argument('--dropout_p', type=int, default=0.2)
-    parser.add_argument('--resume', type=bool, default=False,
-                        help='path to latest checkpoint (default: none)')
+    parser.add_argument('--resume', type=int, default=0,
+                        help='resume from the latest training checkpoint')
     parser.add_argument('--gan_loss', type=float, default=0.1)
+    parser.add_argument('--save_interval', type=int, default=1000,
+                        help='iterations between training checkpoints (one is also written every epoch)')
+    parser.add_argument('--keep_ckpts', type=int, default=3, help='how many training checkpoints to keep')
 
     parser.add_argument('--always_give_global_hint', type=int, default=1)
     parser.add_argument('--multi_injection', type=int, default=1)
     parser.add_argument('--add_L', type=int, default=1)
+    parser.add_argument('--preprocess_in_workers', type=int, default=0,
+                        help='convert images to Lab in the DataLoader workers instead of on the device')
+    parser.add_argument('--use_planes', type=int, default=0,
+                        help='read the precomputed float16 L/ab planes of converted shards')
+    parser.add_argument('--all_shards', type=int, default=0,
+                        help='stream every shard each epoch instead of only shard 0')
+    parser.add_argument('--prefetch_shards', type=int, default=1,
+                        help='shards loaded ahead in the background when streaming')
+    parser.add_argument('--checkpoint_blocks', type=str, nargs='*', default=[], choices=CHECKPOINT_BLOCKS,
+                        help='UNet blocks recomputed in backward to save activation memory')
+    add_device_args(parser)
+    add_amp_args(parser)
+    add_distributed_args(parser)
+    add_profile_args(parser)
     return parser.parse_args()
 
 
 def main(args):
     dataset = args.data
-    gpu = args.gpu
     batch_size = args.batch_size
     dropout_p = args.dropout_p
     model_path = args.model_path
@@ -49,53 +68,101 @@ def main(args):
     multi_injection = args.multi_injection
     add_L = args.add_L
 
-    print("Running on gpu : ", gpu)
-    cuda.set_device(gpu)
-
-    make_folder(model_path, dataset)
-    make_folder(log_path, dataset +'/ckpt')
-
-    (train_dataset, train_loader, imsize) = Color_Dataloader(dataset, batch_size, 0)
-    (G, D, G_optimizer, D_optimizer, G_scheduler, D_scheduler) = init_models(batch_size, imsize, dropout_p, learning_rate, multi_injection, add_L)
+    # --batch_size is per process under DDP
+    distributed = init_distributed(args)
+    if distributed:
+        args.gpu = args.local_rank
+    device = setup_device(args)
+    main_process = is_main_process()
+
+    if main_process:
+        make_folder(model_path, dataset)
+        make_folder(log_path, dataset +'/ckpt')
+
+    (train_dataset, train_loader, imsize) = Color_Dataloader(dataset, batch_size, 0, args.preprocess_in_workers, args.use_planes,
+                                                             args.all_shards, args.prefetch_shards,
+                                                             args.rank, args.world_size)
+    (G, D, G_optimizer, D_optimizer, G_scheduler, D_scheduler) = init_models(batch_size, imsize, dropout_p, learning_rate, multi_injection, add_L,
+                                                                                 device=device, checkpoint_blocks=args.checkpoint_blocks)
         
-    criterion_sL1 = nn.SmoothL1Loss().cuda()
-    criterion_bce = nn.BCELoss().cuda()
-
-    (G, G_optimizer, D, D_optimizer, _, start_epoch) = resume(args.resume, log_path, dataset, G, G_optimizer, D, D_optimizer)
-
-    tell_time = Timer()
-    iter = 0
-    gm = GanModel()
-
-    for epoch in range(start_epoch, num_epochs):
-
-        G.train()
-        for i, (images, pals) in enumerate(train_loader):
-
-            (_, _, loss, sL1_loss) = train(gm, images, pals, G, D, G_optimizer, D_optimizer,
-                                            criterion_bce, criterion_sL1, always_give_global_hint, 
-                                            add_L, gan_loss, True)
-
-            num_batches = (len(train_dataset) // batch_size)
-            print_log(0, 0, epoch, i, num_epochs, num_batches, sL1_loss, tell_time, iter)
-
-        checkpoint = {
-            'epoch': epoch + 1,
-            'args': args,
+    criterion_sL1 = nn.SmoothL1Loss()
+    criterion_bce = nn.BCEWithLogitsLoss()
+
+    precision = Precision(args.amp, device)
+    (G, G_optimizer, D, D_optimizer, step, start_epoch) = resume(args.resume, log_path, dataset, G, G_optimizer, D, D_optimizer,
+                                                                 device, precision)
+    # only rank 0 writes checkpoints; DDP starts every rank from its weights
+    checkpoints = CheckpointManager(os.path.join(log_path, dataset, 'ckpt'), 'model', args.keep_ckpts) \
+                  if main_process else None
+    G_train, D_train = wrap_pcn(G, D, device, args.sync_bn)
+
+    def checkpoint(epoch):
+        return {
+            'epoch': epoch,
+            'step': step,
+            'args': vars(args),
             'G_state_dict': G.state_dict(),
             'G_optimizer': G_optimizer.state_dict(),
             'D_state_dict': D.state_dict(),
-            'D_optimizer': D_optimizer.state_dict()
+            'D_optimizer': D_optimizer.state_dict(),
+            'precision': precision.state_dict()
         }
 
-        torch.save(checkpoint, os.path.join(log_path, dataset, 'ckpt/model.ckpt'))
-        msg = "epoch: %d" % (epoch)
-        if (epoch + 1) % 10 == 0:
-            print ('Saved model')
-            torch.save(G.state_dict(), os.path.join(
-                model_path, dataset, '%s_cGAN-unet_bird256.pkl' % (msg)))
+    tell_time = Timer()
+    iter = 0
+    profiler = Profiler.from_args(args, device)
+    profiler.watch(G, 'G')
+    gm = GanModel(device, precision, profiler)
+
+    completed = False
+    try:
+        for epoch in range(start_epoch, num_epochs):
+
+            G.train()
+            if hasattr(train_dataset, 'set_epoch'):
+                train_dataset.set_epoch(epoch)
+            if hasattr(train_loader.sampler, 'set_epoch'):
+                train_loader.sampler.set_epoch(epoch)
+            for i, (images, pals) in enumerate(profiler.iterate(train_loader)):
+
+                with profiler.stage('step'):
+                    (_, _, loss, sL1_loss) = train(gm, images, pals, G_train, D_train, G_optimizer, D_optimizer,
+                                                    criterion_bce, criterion_sL1, always_give_global_hint, 
+                                                    add_L, gan_loss, True)
+
+                num_batches = len(train_loader)
+                if main_process:
+                    with profiler.stage('log'):
+                        print_log(0, 0, epoch, i, num_epochs, num_batches, sL1_loss, tell_time, iter)
+
+                # mid-epoch checkpoints resume at the start of the same epoch
+                step += 1
+                if main_process and profiler.enabled and step % args.profile_interval == 0:
+                    print(profiler.report())
+                if main_process and step % args.save_interval == 0:
+                    checkpoints.save(checkpoint(epoch), step)
+
+            if not main_process:
+                continue
+            # replaces a mid-epoch checkpoint taken at the same step
+            checkpoints.save(checkpoint(epoch + 1), step)
+            msg = "epoch: %d" % (epoch)
+            if (epoch + 1) % 10 == 0:
+                print ('Saved model')
+                torch.save(G.state_dict(), os.path.join(
+                    model_path, dataset, '%s_cGAN-unet_bird256.pkl' % (msg)))
+        completed = True
+    finally:
+        if main_process and profiler.export(args.profile_dir, 'pal2color'):
+            print('Saved the profile to %s' % args.profile_dir)
+        try:
+            # let the last queued checkpoint reach the disk, without hiding a training error
+            if checkpoints is not None:
+                checkpoints.close(raise_errors=completed)
+        finally:
+            cleanup()
 
 
 if __name__ == '__main__':
     args = parse_args()
-    main(args)
\ No newline at end of file
+    launch(main, args)
\ No newline at end of file
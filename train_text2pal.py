@@ -1,12 +1,14 @@
 #! /usr/bin/env python
 import os, argparse
 import torch
-from torch import cuda
 
 from text2pal.model import *
 from text2pal.data_loader import get_loader
 from text2pal.train import *
 from text2pal.embedding import *
+from text2colors.device import add_device_args, setup_device
+from text2colors.amp import add_amp_args
+from text2colors.profiling import add_profile_args
 
 parser = argparse.ArgumentParser(description='Interactive Colorization through Text')
 
@@ -23,10 +25,16 @@ parser.add_argument('--lambda_sL1', type=float, default=100.0, help='weight for
 parser.add_argument('--lambda_KL', type=float, default=0.5, help='weight for KL loss')
 parser.add_argument('--log_interval',  type=int, default=1,   help='how many steps to wait before logging training status [default: 1]')
 parser.add_argument('--test_interval', type=int, default=100, help='how many steps to wait before testing [default: 100]')
-parser.add_argument('--save_interval', type=int, default=100, help='how many steps to wait before saving [default:500]')
+parser.add_argument('--save_interval', type=int, default=100, help='how many steps to wait before checkpointing [default: 100]')
+parser.add_argument('--keep_ckpts', type=int, default=3, help='how many training checkpoints to keep')
+parser.add_argument('--resume', type=int, default=0, help='resume from the latest training checkpoint')
 parser.add_argument('--save_dir', type=str, default='./text2pal/models', help='where to save the trained models')
 parser.add_argument('--loss_combination', type=str, default='sL1+gan+KL')
+parser.add_argument('--bucket_by_length', type=int, default=1, help='batch palette names of similar length together')
 parser.add_argument('--gpu', type=int, default=0)
+add_device_args(parser)
+add_amp_args(parser)
+add_profile_args(parser)
 args = parser.parse_args()
 
 
@@ -36,33 +44,38 @@ try:
 except OSError:
     pass
 
-cuda.set_device(args.gpu)
-print("Running on GPU : ", args.gpu)
+device = setup_device(args)
 input_dict = prepare_data()
 emb_file = os.path.join('./data', 'Color-Hex-vf.pth')
 
+W_emb = None
 if os.path.isfile(emb_file):
-    W_emb = torch.load(emb_file)
-else:
-    W_emb = load_pretrained_embedding(input_dict.word2index,
-                                      '../data/glove.840B.300d.txt',
-                                      300)
+    W_emb = torch.load(emb_file, map_location='cpu')
+    if W_emb.size(0) != input_dict.n_words:
+        print("%s does not match the vocabulary, using the GloVe cache instead" % emb_file)
+        W_emb = None
+if W_emb is None:
+    W_emb = load_cached_embedding(input_dict.word2index,
+                                  '../data/glove.840B.300d.txt',
+                                  300, os.path.join('./data', 'glove_cache'))
     W_emb = torch.from_numpy(W_emb)
-    torch.save(W_emb, emb_file)
 
-W_emb = W_emb.cuda()
+W_emb = W_emb.to(device)
 
 encoder = EncoderRNN(input_dict.n_words, args.hidden_size,
-                     args.n_layers, args.dropout_p, W_emb).cuda()
+                     args.n_layers, args.dropout_p, W_emb).to(device)
 decoder = AttnDecoderRNN(args.hidden_size, input_dict,
-                         args.n_layers, args.dropout_p).cuda()
-discriminator = Discriminator(15, args.hidden_size).cuda()
+                         args.n_layers, args.dropout_p).to(device)
+discriminator = Discriminator(15, args.hidden_size).to(device)
 
-train_loader, val_loader = get_loader(args.batch_size, input_dict)
+train_loader, val_loader = get_loader(args.batch_size, input_dict, args.bucket_by_length)
 
 print("Begin training...")
 try:
-    TrainGAN(train_loader, val_loader, encoder, decoder, discriminator, args).train()
+    trainer = TrainGAN(train_loader, val_loader, encoder, decoder, discriminator, args, device)
+    if args.resume:
+        trainer.resume()
+    trainer.train()
 except KeyboardInterrupt:
     print('-' * 80)
     print('Exiting from training early')
\ No newline at end of file